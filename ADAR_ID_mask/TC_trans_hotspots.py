@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 from __future__ import division
-import optparse, os
+import optparse, os, gzip
 from subprocess import Popen, PIPE
 #from Bio.Seq import Seq
 #from Bio.Alphabet import generic_dna
@@ -89,22 +89,24 @@ def read_fasta_dict(file):
     
 # Extracts data from a fasta sequence file. Returns two lists, the first holds the names of the seqs (excluding the '>' symbol), and the second holds the sequences
 def read_fasta_lists(file):
-    fin = open(file, 'r')
+    #Gzipped fastas (.gz) are decompressed as they are read
+    if file.endswith('.gz'): fin = gzip.open(file, 'rb')
+    else: fin = open(file, 'r')
     count=0
     
     names=[]
     seqs=[]
-    seq=''
+    seq=[]
     for line in fin:
         line=line.strip()
         if line and line[0] == '>':                #indicates the name of the sequence
             count+=1
             names.append(line[1:])
             if count>1:
-                seqs.append(seq)
-            seq=''
-        else: seq +=line
-    seqs.append(seq)
+                seqs.append(''.join(seq))
+            seq=[]
+        else: seq.append(line)
+    seqs.append(''.join(seq))
     
     return names, seqs
 
@@ -10,7 +10,7 @@
 #In v3.1, Slightly changed the way the sizes for the legend circles is calculated to avoid non-integers
 
 from __future__ import division
-import sys, optparse, os, pysam, math
+import sys, optparse, os, pysam, math, gzip
 import numpy as np
 from scipy.stats import gaussian_kde
 
@@ -233,22 +233,24 @@ def mid4leg(maxfreq):
 
 # will cut fasta name off at the first whitespace
 def read_fasta_lists_simple_names(file):
-    fin = open(file, 'r')
+    #Gzipped fastas (.gz) are decompressed as they are read
+    if file.endswith('.gz'): fin = gzip.open(file, 'rb')
+    else: fin = open(file, 'r')
     count=0
 
     names=[]
     seqs=[]
-    seq=''
+    seq=[]
     for line in fin:
         line=line.strip()
         if line and line[0] == '>':                #indicates the name of the sequence
             count+=1
             names.append(line[1:].split()[0])
             if count>1:
-                seqs.append(seq)
-            seq=''
-        else: seq +=line
-    seqs.append(seq)
+                seqs.append(''.join(seq))
+            seq=[]
+        else: seq.append(line)
+    seqs.append(''.join(seq))
 
     return names, seqs
 
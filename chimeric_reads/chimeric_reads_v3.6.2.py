@@ -39,7 +39,7 @@
 
 
 from __future__ import division
-import sys, optparse, os, pysam, math
+import sys, optparse, os, pysam, math, multiprocessing, collections, json, gzip
 import numpy as np
 from scipy.stats import gaussian_kde
 
@@ -65,6 +65,10 @@ def main():
     p.add_option('-f', '--buff', default = 0, type='int', help='Used to expand the x and y limits of the plots beyond the beginning and end of the references. The buffer is applied equally to min/max and x/y. [0]')
     p.add_option('--filterDups', default = False, action='store_true', help='Use this flag if you do not want to include putative duplicate counts in the figures that are generated. [False]')
     p.add_option('--dataStranded', default = False, action='store_true', help='Use this flag if your data is strand-specific. [False]')
+    p.add_option('--procs', default = 1, type='int', help='Number of processes to use when reading through the sam/bam file. With more than 1, the bam is split up by reference (or by --window) and each piece is read in a separate process. Requires a sorted and indexed bam. [1]')
+    p.add_option('--window', default = 0, type='int', help='Size (in bp) of the regions used to split up the bam across --procs. Useful when most of the reads map to a single reference. 0 = split by reference only. Requires a sorted and indexed bam. [0]')
+    p.add_option('--candidates', default = False, action='store_true', help='Use this flag to save the chimeric candidates (alignments with SA tags that are not R2) to a small bam (<sam/bam name>_SAcandidates.bam, or <-o>_SAcandidates.bam for stdin), along with the counts of all mapped reads, while reading through the sam/bam. When this flag is used again for the same sam/bam (e.g., with different --minPerc or --filterDups), the candidates bam is read instead of the full sam/bam, as long as it is newer. For stdin, the candidates bam is always written again and never read [False]')
+    p.add_option('--nameSorted', default = False, action='store_true', help='Use this flag if the sam/bam is sorted or grouped by read name (e.g., samtools sort -n or samtools collate). Each chimeric read is classified and written out as soon as all of its alignments have been read, instead of after reading the whole file. Does not need an index, and "-b -" can be used to read from stdin. --procs and --window are not used. [False]')
 
     opts, args = p.parse_args()
 
@@ -79,13 +83,6 @@ def main():
 #Reads through a bam file, identifies chimeric reads, creates several outputs summarizing those chimeras, including a plot
 def process_bam(bamname, outname, opts):
 
-    #One key for every mapped read that has a secondary alignment (and is R1, as currently written)
-    #Keys are lists of lists with info about the different alignments
-    SA_info = {}
-    #One key for every ref, values are dicts. One key for every mapped readname, values are lists of % read bases aligned (or matched). One entry in list for each alignment. True = reverse strand, False = forward (NO R1 filter at the moment!!!)
-    all_aligned = {}
-    #One key for every read, values are dicts. One key for ref read is aligned to, values are lists of True/False. One entry in list for each alignment. True = reverse strand, False = forward (NO R1 filter at the moment!!!)
-    all_align_flip = {}
     #Create an Alignment File object using pysam
     bam = pysam.AlignmentFile(bamname)
 
@@ -96,39 +93,45 @@ def process_bam(bamname, outname, opts):
     for index, r in enumerate(bam.references):
         reflen_dict[r]=bam.lengths[index]
 
-    #Step through all of the reads
-    for read in bam.fetch():
-        #To keep track of all mapped reads
-        if not read.is_unmapped: 
-            if read.reference_name not in all_aligned: all_aligned[read.reference_name]={}
-            if read.query_name not in all_aligned[read.reference_name]: all_aligned[read.reference_name][read.query_name]=[]
-
-            if read.query_name not in all_align_flip: all_align_flip[read.query_name]={}
-            if read.reference_name not in all_align_flip[read.query_name]: all_align_flip[read.query_name][read.reference_name]=[]
-            all_align_flip[read.query_name][read.reference_name].append(read.is_reverse)
-        
-            #Find chimeric reads
-            #Check to make sure that 1) the read has a supplementary alignment AND 2) that it is not read 2
-            if read.has_tag("SA"):
-                if not read.is_read2:
-                    #Add read name to dict if not already present
-                    if read.query_name not in SA_info: SA_info[read.query_name]=[]
-            
-                    #Checks for hard clipped bases, and corrects pairs and length for this, if present
-                    if 5 in [x[0] for x in read.cigartuples]:
-                        corr_pairs, corr_length = corr_hardclipped(read)
-                        #Add info about this alignment
-                        all_aligned[read.reference_name][read.query_name].append(len(corr_pairs)/corr_length)
-                        if read.is_reverse: SA_info[read.query_name].append([read.reference_name, corr_length, corr_pairs, read.cigarstring, read.is_reverse, flip(corr_pairs, corr_length)])
-                        else: SA_info[read.query_name].append([read.reference_name, corr_length, corr_pairs, read.cigarstring, read.is_reverse, corr_pairs])
-
-                    else:
-                        #Add info about this alignment
-                        all_aligned[read.reference_name][read.query_name].append(len(read.get_aligned_pairs(matches_only=True))/read.infer_query_length())
-                        if read.is_reverse: SA_info[read.query_name].append([read.reference_name, read.infer_query_length(), read.get_aligned_pairs(matches_only=True), read.cigarstring, read.is_reverse, flip(read.get_aligned_pairs(matches_only=True), read.infer_query_length())])
-                        else: SA_info[read.query_name].append([read.reference_name, read.infer_query_length(), read.get_aligned_pairs(matches_only=True), read.cigarstring, read.is_reverse, read.get_aligned_pairs(matches_only=True)])
-            else: 
-                all_aligned[read.reference_name][read.query_name].append(len(read.get_aligned_pairs(matches_only=True))/read.infer_query_length())
+    #With --candidates, the chimeric candidates are written to temp bams while reading through the sam/bam, which are combined into cand_name at the end
+    cand_name = candidates_name(bamname, outname)
+    cand_temps = []
+
+    #Reads with SA tags and the counts of all mapped reads saved by an earlier run with --candidates
+    #Never used for stdin, because there is no way to tell whether the same sam/bam is being piped in again
+    if opts.candidates and bamname != '-' and os.path.isfile(cand_name) and os.path.getmtime(cand_name) >= os.path.getmtime(bamname):
+        print "Reading chimeric candidates from %s" % (cand_name)
+        bam.close()
+        SA_info, read_counts = read_candidates(cand_name)
+        SA_reads = SA_info.iteritems()
+
+    #For bams grouped by read name, the reads are read while the chimeric reads are being classified below
+    elif opts.nameSorted:
+        if 'SO:coordinate' in bam.text:
+            print "PROBLEM!!! %s is sorted by coordinate, --nameSorted needs a sam/bam that is sorted or grouped by read name" % (bamname)
+            return
+        if opts.candidates: cand_temps = ['%s.tmp' % (cand_name)]
+        read_counts = new_read_counts()
+        SA_reads = name_grouped_alignments(bam, read_counts, cand_temps)
+
+    #Otherwise, step through all of the reads, either in this process or split up by reference (or window) and spread across opts.procs processes
+    #Splitting the bam up requires an index, so the whole file is still read in one pass when --procs is 1 and --window is not used
+    else:
+        if opts.procs>1 or opts.window: tasks=[[bamname, ref, start, end, None] for ref, start, end in bam_shards(bam, opts.window)]
+        else: tasks=[[bamname, None, None, None, None]]
+        bam.close()
+        if opts.candidates:
+            for index, task in enumerate(tasks): task[4]='%s.%d.tmp' % (cand_name, index)
+            cand_temps = [task[4] for task in tasks]
+
+        if opts.procs>1 or opts.window:
+            pool=multiprocessing.Pool(opts.procs)
+            results=pool.map(collect_alignments, tasks)
+            pool.close()
+            pool.join()
+        else: results=[collect_alignments(tasks[0])]
+        SA_info, read_counts = merge_alignments(results)
+        SA_reads = SA_info.iteritems()
 
 ####--------------End of stepping through sam/bam file--------------------->>>>>>>>>>>>>>>
 
@@ -149,7 +152,7 @@ def process_bam(bamname, outname, opts):
     ldup_uniq_reads = {}
     sdup_uniq_reads = {}
     cb_uniq_reads = {}
-    for k in all_aligned.keys():
+    for k in reflen_dict.keys():
         del_uniq_reads[k]={}
         ldup_uniq_reads[k] = {}
         sdup_uniq_reads[k] = {}
@@ -199,13 +202,16 @@ def process_bam(bamname, outname, opts):
 
 
     #Step through each read name with at least one secondary alignment
-    for read, info in SA_info.iteritems():
+    num_SA = 0
+    for read, info in SA_reads:
+        num_SA+=1
         num_aligns = len([x[0] for x in info])
         num_ref = len(set([x[0] for x in info]))
         num_strand = len(set([x[4] for x in info]))
-        qsites_aligned, qwithdups = get_aligned([x[5] for x in info], 0)
-        rsites_aligned, rwithdups = get_aligned([x[2] for x in info], 1)
-        percQaligned = len(qsites_aligned)/max([x[1] for x in info])
+        #qsites_aligned are the (merged) intervals of the read that are aligned, qwithdups is the # of aligned read bases, counting bases in both alignments twice
+        qsites_aligned, qwithdups = get_aligned([x[5] for x in info])
+        overlap = qwithdups - intervals_len(qsites_aligned)
+        percQaligned = intervals_len(qsites_aligned)/max([x[1] for x in info])
         #Returns a list with 3 values, # bases from the beginning of the read unaligned, num from middle and num from end
         qUnaligned = calcmissing(qsites_aligned, max([x[1] for x in info]))
         
@@ -252,7 +258,7 @@ def process_bam(bamname, outname, opts):
                     diffref_samestrand+=1
                     if percQaligned >= opts.minPerc: 
                         diffref_samestrand_full+=1
-                        overlaps['diffref-samestrand'].append(len(qwithdups) - len(qsites_aligned))
+                        overlaps['diffref-samestrand'].append(overlap)
                     else:
                         diffref_samestrand_partial.append(percQaligned)
                 #Alignments to two different strands
@@ -260,7 +266,7 @@ def process_bam(bamname, outname, opts):
                     diffref_diffstrand+=1
                     if percQaligned >= opts.minPerc: 
                         diffref_diffstrand_full+=1
-                        overlaps['diffref-diffstrand'].append(len(qwithdups) - len(qsites_aligned))
+                        overlaps['diffref-diffstrand'].append(overlap)
                     else:
                         diffref_diffstrand_partial.append(percQaligned)
 
@@ -311,8 +317,8 @@ def process_bam(bamname, outname, opts):
 
             #If there are missing bases and the alignments are oriented such that the missing bases are consistent with a simple deletion
             if missing and orient=='correct': 
-                overlaps['deletions'].append(len(qwithdups) - len(qsites_aligned))
-                delsig = "%d\t%d\t%d\t%d\t%d\t%d\t%d\t%s" % (len(missing), min(missing)+1, max(missing)+1, max([x[1] for x in info]), len(info[0][2]), len(info[1][2]), len(qwithdups) - len(qsites_aligned), "\t".join([str(x) for x in qUnaligned]))
+                overlaps['deletions'].append(overlap)
+                delsig = "%d\t%d\t%d\t%d\t%d\t%d\t%d\t%s" % (intervals_len(missing), missing[0][0]+1, missing[-1][1], max([x[1] for x in info]), blocks_len(info[0][2]), blocks_len(info[1][2]), overlap, "\t".join([str(x) for x in qUnaligned]))
                 if delsig in del_uniq_reads[info[0][0]]: fout_del.write("%s\tDeletion\t%s\t%s\t%s\t0\n" % (read, info[0][0], delsig, strand))
                 else:
                     del_uniq_reads[info[0][0]][delsig]=''
@@ -320,10 +326,10 @@ def process_bam(bamname, outname, opts):
 
             else:
                 ####!!!! Do I need to adjust?!?!?!
-                common = common_bases([x[1] for x in info[0][2]], [x[1] for x in info[1][2]])
+                common = common_bases(info[0][2], info[1][2])
                 if common and orient=='correct':
-                    overlaps['smalldups'].append(len(qwithdups) - len(qsites_aligned))
-                    sdupsig = "%d\t%d\t%d\t%d\t%d\t%d\t%d\t%s" % (len(common), min(common)+1, max(common)+1, max([x[1] for x in info]), len(info[0][2]), len(info[1][2]), len(qwithdups) - len(qsites_aligned), "\t".join([str(x) for x in qUnaligned]))
+                    overlaps['smalldups'].append(overlap)
+                    sdupsig = "%d\t%d\t%d\t%d\t%d\t%d\t%d\t%s" % (intervals_len(common), common[0][0]+1, common[-1][1], max([x[1] for x in info]), blocks_len(info[0][2]), blocks_len(info[1][2]), overlap, "\t".join([str(x) for x in qUnaligned]))
                     if sdupsig in sdup_uniq_reads[info[0][0]]: fout_sdup.write("%s\tSmallDup\t%s\t%s\t%s\t0\n" % (read, info[0][0], sdupsig, strand))
                     else:
                         sdup_uniq_reads[info[0][0]][sdupsig]=''
@@ -331,35 +337,35 @@ def process_bam(bamname, outname, opts):
 
                 #There has been some type of rearrangement event, most likely a large scale duplication
                 elif orient=='inverted': 
-                    overlaps['largedups'].append(len(qwithdups) - len(qsites_aligned))
-                    allref = [x[1] for x in info[0][2]] + [x[1] for x in info[1][2]]
-                    ldupsig = "%d\t%d\t%d\t%d\t%d\t%d\t%d\t%s" % (max(allref)-min(allref)+1, min(allref)+1, max(allref)+1, max([x[1] for x in info]), len(info[0][2]), len(info[1][2]), len(qwithdups) - len(qsites_aligned), "\t".join([str(x) for x in qUnaligned]))
+                    overlaps['largedups'].append(overlap)
+                    allref = [ref_min(info[0][2]), ref_max(info[0][2]), ref_min(info[1][2]), ref_max(info[1][2])]
+                    ldupsig = "%d\t%d\t%d\t%d\t%d\t%d\t%d\t%s" % (max(allref)-min(allref)+1, min(allref)+1, max(allref)+1, max([x[1] for x in info]), blocks_len(info[0][2]), blocks_len(info[1][2]), overlap, "\t".join([str(x) for x in qUnaligned]))
                     if ldupsig in ldup_uniq_reads[info[0][0]]: fout_ldup.write("%s\tLargeDup\t%s\t%s\t%s\t0\n" % (read, info[0][0], ldupsig, strand))
                     else:
                         ldup_uniq_reads[info[0][0]][ldupsig]=''
                         fout_ldup.write("%s\tLargeDup\t%s\t%s\t%s\t1\n" % (read, info[0][0], ldupsig, strand))
 
                 else:
-                    print "Unknown!!!", max([x[1] for x in info]), len(info[0][2]), len(info[1][2])
+                    print "Unknown!!!", max([x[1] for x in info]), blocks_len(info[0][2]), blocks_len(info[1][2])
 
         #Copyback
         #Check to make sure that there are only two alignments, that they are mapped to the different strands and that they are both to the same reference and that the minPerc of the read is aligned, when considering both alignments
         elif num_aligns == 2 and num_strand == 2 and num_ref == 1 and percQaligned >= opts.minPerc:
             #If the first alignment in the list is the first part of the read
-            overlaps['copyback'].append(len(qwithdups) - len(qsites_aligned))
-            if min([x[0] for x in info[0][5]])<min([x[0] for x in info[1][5]]):
+            overlaps['copyback'].append(overlap)
+            if info[0][5][0][0]<info[1][5][0][0]:
                 #If the first alignment in the read is in the reverse orientation
                 if info[0][4]:
-                    mins_ref =  min([x[1] for x in info[0][5]]), min([x[1] for x in info[1][5]])
-                    cbsig = "3prime\t%d\t%d\t%d\t%d\t%d\t%d\t%s" % (min(mins_ref)+1, max(mins_ref)+1, max([x[1] for x in info]), len(info[0][2]), len(info[1][2]), len(qwithdups) - len(qsites_aligned), "\t".join([str(x) for x in qUnaligned]))
+                    mins_ref =  ref_min(info[0][2]), ref_min(info[1][2])
+                    cbsig = "3prime\t%d\t%d\t%d\t%d\t%d\t%d\t%s" % (min(mins_ref)+1, max(mins_ref)+1, max([x[1] for x in info]), blocks_len(info[0][2]), blocks_len(info[1][2]), overlap, "\t".join([str(x) for x in qUnaligned]))
                     if cbsig in cb_uniq_reads[info[0][0]]: fout_cback.write("%s\tCopyBack\t%s\t%s\treverse,forward\t0\n" % (read, info[0][0], cbsig))
                     else:
                         cb_uniq_reads[info[0][0]][cbsig]=''
                         fout_cback.write("%s\tCopyBack\t%s\t%s\treverse,forward\t1\n" % (read, info[0][0], cbsig))
                 #If the second alignment in the read is in the reverse orientation
                 else:
-                    maxs_ref =  max([x[1] for x in info[0][5]]), max([x[1] for x in info[1][5]])
-                    cbsig = "5prime\t%d\t%d\t%d\t%d\t%d\t%d\t%s" % (min(maxs_ref)+1, max(maxs_ref)+1, max([x[1] for x in info]), len(info[0][2]), len(info[1][2]), len(qwithdups) - len(qsites_aligned), "\t".join([str(x) for x in qUnaligned]))
+                    maxs_ref =  ref_max(info[0][2]), ref_max(info[1][2])
+                    cbsig = "5prime\t%d\t%d\t%d\t%d\t%d\t%d\t%s" % (min(maxs_ref)+1, max(maxs_ref)+1, max([x[1] for x in info]), blocks_len(info[0][2]), blocks_len(info[1][2]), overlap, "\t".join([str(x) for x in qUnaligned]))
                     if cbsig in cb_uniq_reads[info[0][0]]: fout_cback.write("%s\tCopyBack\t%s\t%s\tforward,reverse\t0\n" % (read, info[0][0], cbsig))
                     else:
                         cb_uniq_reads[info[0][0]][cbsig]=''
@@ -368,16 +374,16 @@ def process_bam(bamname, outname, opts):
             else:
                 #If the first alignment in the read is in the reverse orientation
                 if info[1][4]:
-                    mins_ref =  min([x[1] for x in info[0][5]]), min([x[1] for x in info[1][5]])
-                    cbsig = "3prime\t%d\t%d\t%d\t%d\t%d\t%d\t%s" % (min(mins_ref)+1, max(mins_ref)+1, max([x[1] for x in info]), len(info[0][2]), len(info[1][2]), len(qwithdups) - len(qsites_aligned), "\t".join([str(x) for x in qUnaligned]))
+                    mins_ref =  ref_min(info[0][2]), ref_min(info[1][2])
+                    cbsig = "3prime\t%d\t%d\t%d\t%d\t%d\t%d\t%s" % (min(mins_ref)+1, max(mins_ref)+1, max([x[1] for x in info]), blocks_len(info[0][2]), blocks_len(info[1][2]), overlap, "\t".join([str(x) for x in qUnaligned]))
                     if cbsig in cb_uniq_reads[info[0][0]]: fout_cback.write("%s\tCopyBack\t%s\t%s\treverse,forward\t0\n" % (read, info[0][0], cbsig))
                     else:
                         cb_uniq_reads[info[0][0]][cbsig]=''
                         fout_cback.write("%s\tCopyBack\t%s\t%s\treverse,forward\t1\n" % (read, info[0][0], cbsig))
                 #If the second alignment in the read is in the reverse orientation
                 else:
-                    maxs_ref =  max([x[1] for x in info[0][5]]), max([x[1] for x in info[1][5]])
-                    cbsig = "5prime\t%d\t%d\t%d\t%d\t%d\t%d\t%s" % (min(maxs_ref)+1, max(maxs_ref)+1, max([x[1] for x in info]), len(info[0][2]), len(info[1][2]), len(qwithdups) - len(qsites_aligned), "\t".join([str(x) for x in qUnaligned]))
+                    maxs_ref =  ref_max(info[0][2]), ref_max(info[1][2])
+                    cbsig = "5prime\t%d\t%d\t%d\t%d\t%d\t%d\t%s" % (min(maxs_ref)+1, max(maxs_ref)+1, max([x[1] for x in info]), blocks_len(info[0][2]), blocks_len(info[1][2]), overlap, "\t".join([str(x) for x in qUnaligned]))
                     if cbsig in cb_uniq_reads[info[0][0]]: fout_cback.write("%s\tCopyBack\t%s\t%s\tforward,reverse\t0\n" % (read, info[0][0], cbsig))
                     else:
                         cb_uniq_reads[info[0][0]][cbsig]=''
@@ -389,19 +395,15 @@ def process_bam(bamname, outname, opts):
     fout_ldup.close()
     fout_cback.close()
 
+    #Combine the chimeric candidates into one bam for later runs with --candidates. This is done after the loop above, because read_counts is not finished until then for --nameSorted
+    if cand_temps: write_candidates(cand_name, cand_temps, read_counts, opts)
+
 ####-----Start of section printing some summary stats to stdout--------############
 
-    num_aligned = len(all_align_flip)
-    single=0
-    single_for=0
-    single_rev=0
-    for read in all_align_flip.values():
-        if len(read)==1:
-            for ref in read.values():
-                if len(ref) == 1:
-                    single+=1
-                    if ref[0]: single_rev+=1
-                    else: single_for+=1
+    num_aligned = read_counts['names']
+    single_for = read_counts['single_for']
+    single_rev = read_counts['single_rev']
+    single = single_for + single_rev
     
     print "\nTotal_Aligned: %d" % (num_aligned)
     print "\t2Alignments_Full(>%.1f%%_read_aligned): %d (%.2f%%)" % (opts.minPerc*100, diffref_diffstrand_full+diffref_samestrand_full+two_diff_full+two_same_full, (diffref_diffstrand_full+diffref_samestrand_full+two_diff_full+two_same_full)/num_aligned*100)
@@ -409,22 +411,20 @@ def process_bam(bamname, outname, opts):
     print "\t\tForwardStrand: %d (%.2f%%)" % (single_for, single_for/single*100)
     print "\t\tReverseStrand: %d (%.2f%%)" % (single_rev, single_rev/single*100)
 
-    for ref, reads in all_aligned.iteritems():
-        single_perc_aligned=[]
-        for read in reads:
-            #Check that there the read has only one alignment, whether to the same ref or different refs
-            if len(all_aligned[ref][read]) == 1 and len(all_align_flip[read]) == 1:
-                single_perc_aligned.append(all_aligned[ref][read][0])
+    for ref in read_counts['ref_names']:
+        #% of read bases aligned for the reads that only have one alignment, whether to the same ref or different refs, and the # of reads with each %
+        single_perc_aligned, single_nums = hist_arrays(read_counts['single_aligned'].get(ref, {}))
+        full = single_perc_aligned>=opts.minPerc
         print "\t\t%s:" % (ref)
-        print "\t\t\tAvg%%_Read_Aligned: %.2f (STD: %.2f)" % (np.mean(single_perc_aligned)*100, np.std(single_perc_aligned)*100)
-        print "\t\t\tFull(>%.1f%%_read_aligned): %.2f (%.2f)" % (opts.minPerc*100, len([x for x in single_perc_aligned if x>=opts.minPerc]), len([x for x in single_perc_aligned if x>=opts.minPerc])/len(single_perc_aligned)*100)
-        print "\t\t\tPartial: %.2f (%.2f); avg%%aligned: %.2f" % (len([x for x in single_perc_aligned if x<opts.minPerc]), len([x for x in single_perc_aligned if x<opts.minPerc])/len(single_perc_aligned)*100, np.mean([x for x in single_perc_aligned if x<opts.minPerc])*100)
+        print "\t\t\tAvg%%_Read_Aligned: %.2f (STD: %.2f)" % (hist_mean(single_perc_aligned, single_nums)*100, hist_std(single_perc_aligned, single_nums)*100)
+        print "\t\t\tFull(>%.1f%%_read_aligned): %.2f (%.2f)" % (opts.minPerc*100, single_nums[full].sum(), single_nums[full].sum()/single_nums.sum()*100)
+        print "\t\t\tPartial: %.2f (%.2f); avg%%aligned: %.2f" % (single_nums[~full].sum(), single_nums[~full].sum()/single_nums.sum()*100, hist_mean(single_perc_aligned[~full], single_nums[~full])*100)
 
 
-    print "\nTotal_wSecondaryAlignments: %d (%.2f%%)" % (len(SA_info), len(SA_info)/num_aligned*100)
-    if SA_info:
-        print "\t>2_Alignments: %d (%.2f%%)" % (len(morethantwo[0]), len(morethantwo[0])/len(SA_info)*100)
-        print "\tOnly2_Alignments: %d (%.2f%%)" % (only2, only2/len(SA_info)*100)
+    print "\nTotal_wSecondaryAlignments: %d (%.2f%%)" % (num_SA, num_SA/num_aligned*100)
+    if num_SA:
+        print "\t>2_Alignments: %d (%.2f%%)" % (len(morethantwo[0]), len(morethantwo[0])/num_SA*100)
+        print "\tOnly2_Alignments: %d (%.2f%%)" % (only2, only2/num_SA*100)
         
         print "\t\tDiff_Ref: %d (%.2f%%)" % (diffref, diffref/only2*100)
         if diffref:
@@ -508,7 +508,7 @@ def process_bam(bamname, outname, opts):
             if ovlponly: print "\t%s\t%.3f\t%.3f\t%.2f\t%.3f\t%.3f" % (k, np.mean(overlaps[k]), np.std(overlaps[k]), len(ovlponly)/len(overlaps[k])*100, np.mean(ovlponly), np.std(ovlponly))
             else: print "\t%s\t%.3f\t%.3f\tNA\tNA\tNA" % (k, np.mean(overlaps[k]), np.std(overlaps[k]))
 #    print "Total_wSecondary\tPercSecondary\tTotalAligned"
-#    print len(SA_info), len(SA_info)/num_aligned*100, num_aligned
+#    print num_SA, num_SA/num_aligned*100, num_aligned
 
 #    print "2 Alignments only:"
 #    print "SameRef (SR)\tSR SameStrand (SS)\tSR DiffStrand (DS)\tSRSS-Full\tSRSS-Partial\tSRDS-Full\tSRDS-Partial\tDiffRef (DR)\tDR-Full\tDR-Partial"
@@ -543,97 +543,377 @@ def process_bam(bamname, outname, opts):
 
     #Write info for different types of chimeras
     for ref, info in del_info.iteritems():
-        fout.write("%s\t%s\t%d\t%d\t%.4f\t%.4f\t%d\t%.4f\n" % (ref, "Deletions", len(info.keys()), sum(info.values()), np.mean(info.values()), np.std(info.values()), len(all_aligned[ref]), sum(info.values())/len(all_aligned[ref])))
-        foutall.write("%s\t%s\t%s\t%d\t%d\t%.4f\t%.4f\t%d\t%.4f\n" % (bamname, ref, "Deletions", len(info.keys()), sum(info.values()), np.mean(info.values()), np.std(info.values()), len(all_aligned[ref]), sum(info.values())/len(all_aligned[ref])))
+        fout.write("%s\t%s\t%d\t%d\t%.4f\t%.4f\t%d\t%.4f\n" % (ref, "Deletions", len(info.keys()), sum(info.values()), np.mean(info.values()), np.std(info.values()), read_counts['ref_names'][ref], sum(info.values())/read_counts['ref_names'][ref]))
+        foutall.write("%s\t%s\t%s\t%d\t%d\t%.4f\t%.4f\t%d\t%.4f\n" % (bamname, ref, "Deletions", len(info.keys()), sum(info.values()), np.mean(info.values()), np.std(info.values()), read_counts['ref_names'][ref], sum(info.values())/read_counts['ref_names'][ref]))
     for ref, info in sdup_info.iteritems():
-        fout.write("%s\t%s\t%d\t%d\t%.4f\t%.4f\t%d\t%.4f\n" % (ref, "SmallDups", len(info.keys()), sum(info.values()), np.mean(info.values()), np.std(info.values()), len(all_aligned[ref]), sum(info.values())/len(all_aligned[ref])))
-        foutall.write("%s\t%s\t%s\t%d\t%d\t%.4f\t%.4f\t%d\t%.4f\n" % (bamname, ref, "SmallDups", len(info.keys()), sum(info.values()), np.mean(info.values()), np.std(info.values()), len(all_aligned[ref]), sum(info.values())/len(all_aligned[ref])))
+        fout.write("%s\t%s\t%d\t%d\t%.4f\t%.4f\t%d\t%.4f\n" % (ref, "SmallDups", len(info.keys()), sum(info.values()), np.mean(info.values()), np.std(info.values()), read_counts['ref_names'][ref], sum(info.values())/read_counts['ref_names'][ref]))
+        foutall.write("%s\t%s\t%s\t%d\t%d\t%.4f\t%.4f\t%d\t%.4f\n" % (bamname, ref, "SmallDups", len(info.keys()), sum(info.values()), np.mean(info.values()), np.std(info.values()), read_counts['ref_names'][ref], sum(info.values())/read_counts['ref_names'][ref]))
     for ref, info in ldup_info.iteritems():
-        fout.write("%s\t%s\t%d\t%d\t%.4f\t%.4f\t%d\t%.4f\n" % (ref, "LargeDups", len(info.keys()), sum(info.values()), np.mean(info.values()), np.std(info.values()), len(all_aligned[ref]), sum(info.values())/len(all_aligned[ref])))
-        foutall.write("%s\t%s\t%s\t%d\t%d\t%.4f\t%.4f\t%d\t%.4f\n" % (bamname, ref, "LargeDups", len(info.keys()), sum(info.values()), np.mean(info.values()), np.std(info.values()), len(all_aligned[ref]), sum(info.values())/len(all_aligned[ref])))
+        fout.write("%s\t%s\t%d\t%d\t%.4f\t%.4f\t%d\t%.4f\n" % (ref, "LargeDups", len(info.keys()), sum(info.values()), np.mean(info.values()), np.std(info.values()), read_counts['ref_names'][ref], sum(info.values())/read_counts['ref_names'][ref]))
+        foutall.write("%s\t%s\t%s\t%d\t%d\t%.4f\t%.4f\t%d\t%.4f\n" % (bamname, ref, "LargeDups", len(info.keys()), sum(info.values()), np.mean(info.values()), np.std(info.values()), read_counts['ref_names'][ref], sum(info.values())/read_counts['ref_names'][ref]))
     for ref, info in cback_info.iteritems():
-        fout.write("%s\t%s\t%d\t%d\t%.4f\t%.4f\t%d\t%.4f\n" % (ref, "CopyBacks", len(info.keys()), sum(info.values()), np.mean(info.values()), np.std(info.values()), len(all_aligned[ref]), sum(info.values())/len(all_aligned[ref])))
-        foutall.write("%s\t%s\t%s\t%d\t%d\t%.4f\t%.4f\t%d\t%.4f\n" % (bamname, ref, "CopyBacks", len(info.keys()), sum(info.values()), np.mean(info.values()), np.std(info.values()), len(all_aligned[ref]), sum(info.values())/len(all_aligned[ref])))
+        fout.write("%s\t%s\t%d\t%d\t%.4f\t%.4f\t%d\t%.4f\n" % (ref, "CopyBacks", len(info.keys()), sum(info.values()), np.mean(info.values()), np.std(info.values()), read_counts['ref_names'][ref], sum(info.values())/read_counts['ref_names'][ref]))
+        foutall.write("%s\t%s\t%s\t%d\t%d\t%.4f\t%.4f\t%d\t%.4f\n" % (bamname, ref, "CopyBacks", len(info.keys()), sum(info.values()), np.mean(info.values()), np.std(info.values()), read_counts['ref_names'][ref], sum(info.values())/read_counts['ref_names'][ref]))
 
     fout.close()
     foutall.close()
 
 ####-----End of process_bam()--------############
 
+#Returns a list of regions to split the bam up by: [ref, start, end]. One region per reference, or windows of this size if window>0
+def bam_shards(bam, window):
+    shards=[]
+    for index, ref in enumerate(bam.references):
+        if window:
+            for start in range(0, bam.lengths[index], window): shards.append([ref, start, min(start+window, bam.lengths[index])])
+        else: shards.append([ref, 0, bam.lengths[index]])
+    return shards
+
+#Called for each region of the bam (or once for the whole bam, if ref is None), for the reads that start within this region
+#Returns SA_info, running counts for the summary of all mapped reads (see new_read_counts()) and the reads that are still waiting for some of their alignments
+#OrderedDicts are used so that the reads can be merged back together in the same order that they would have been seen in a single pass
+def collect_alignments(task):
+    bamname, region_ref, start, end, cand_temp = task
+
+    #One key for every mapped read that has a secondary alignment (and is R1, as currently written)
+    #Keys are lists of lists with info about the different alignments: [ref, read length, aligned blocks, cigar, is_reverse, aligned read intervals]
+        #See aligned_blocks() and query_intervals() for the last two
+    SA_info = collections.OrderedDict()
+    read_counts = new_read_counts()
+    #One key for every read name that has been seen, but not all of its alignments (mates and supplementary alignments). See count_alignment()
+    pending = {}
+    #Create an Alignment File object using pysam
+    bam = pysam.AlignmentFile(bamname)
+    #To save the chimeric candidates, with --candidates
+    if cand_temp: candidates = pysam.AlignmentFile(cand_temp, 'wb', template=bam)
+    else: candidates = None
+
+    if region_ref is None: reads = bam.fetch()
+    else: reads = bam.fetch(region_ref, start, end)
+
+    for read in reads:
+        #Reads that overlap the start of this region are counted in the region where they begin
+        if region_ref is not None and read.reference_start < start: continue
+        add_alignment(read, SA_info, pending, read_counts, candidates)
+
+    bam.close()
+    if candidates: candidates.close()
+    return SA_info, read_counts, pending
+
+#Reads through a bam that is grouped by read name, and yields (read name, SA_info list) for each chimeric read as soon as all of its alignments have been read
+#read_counts is updated along the way, and is complete once all of the reads have been yielded
+#If a temp bam name is given in cand_temps, the chimeric candidates are written to it
+def name_grouped_alignments(bam, read_counts, cand_temps):
+    if cand_temps: candidates = pysam.AlignmentFile(cand_temps[0], 'wb', template=bam)
+    else: candidates = None
+    SA_info = collections.OrderedDict()
+    pending = {}
+    ref_order = dict([(ref, index) for index, ref in enumerate(bam.references)])
+    last_name = None
+    for read in bam.fetch(until_eof=True):
+        if read.query_name != last_name:
+            for chimera in finish_name_group(SA_info, pending, read_counts, ref_order): yield chimera
+            last_name = read.query_name
+        add_alignment(read, SA_info, pending, read_counts, candidates)
+    for chimera in finish_name_group(SA_info, pending, read_counts, ref_order): yield chimera
+    bam.close()
+    if candidates: candidates.close()
+
+#Called once all of the alignments for a read name have been read, returns the SA_info for the read (if any) and empties SA_info and pending
+#Anything left in pending is missing some of its alignments (e.g., mates that were filtered out of the bam), so it is counted with the alignments that are present
+#The alignments are put in coordinate order (reference order in the header, then leftmost position), which is the order they are seen in a coordinate sorted bam, so that the left and right parts of each read are the same as without --nameSorted
+def finish_name_group(SA_info, pending, read_counts, ref_order):
+    for info in pending.values(): finish_read(info, read_counts)
+    pending.clear()
+    chimeras = [(name, sorted(info, key=lambda x: (ref_order[x[0]], ref_min(x[2])))) for name, info in SA_info.iteritems()]
+    SA_info.clear()
+    return chimeras
+
+#Adds the info for one alignment to SA_info (if it is chimeric) and to the counts of mapped reads
+#Alignments that are added to SA_info are also written to candidates, if it is an open bam
+def add_alignment(read, SA_info, pending, read_counts, candidates=None):
+    #To keep track of all mapped reads
+    if not read.is_unmapped: 
+        #Matched and total read bases, for the % of the read aligned (NO R1 filter at the moment!!!, but R2 alignments with SA tags are not included)
+        aligned = None
+
+        #Find chimeric reads
+        #Check to make sure that 1) the read has a supplementary alignment AND 2) that it is not read 2
+        if read.has_tag("SA"):
+            if not read.is_read2:
+                #Add read name to dict if not already present
+                if read.query_name not in SA_info: SA_info[read.query_name]=[]
+        
+                #Aligned blocks from the cigar string, with hard clipped bases included in the read coordinates and length
+                blocks, length = aligned_blocks(read)
+                #Add info about this alignment
+                aligned = (blocks_len(blocks), length)
+                SA_info[read.query_name].append([read.reference_name, length, blocks, read.cigarstring, read.is_reverse, query_intervals(blocks, length, read.is_reverse)])
+                if candidates: candidates.write(read)
+        else: 
+            cigar_stats = read.get_cigar_stats()[0]
+            aligned = (cigar_stats[0]+cigar_stats[7]+cigar_stats[8], read.infer_query_length())
+
+        #Secondary alignments (only written by bwa mem with -a) are not included in the counts of mapped reads
+        if not read.is_secondary: count_alignment(read, aligned, pending, read_counts)
+
+#Name of the bam of chimeric candidates for --candidates, which is saved next to the sam/bam
+def candidates_name(bamname, outname):
+    if bamname == '-': return '%s_SAcandidates.bam' % (outname)
+    return '%s_SAcandidates.bam' % (os.path.splitext(bamname)[0])
+
+#Combines the temp bams of chimeric candidates (in order) into one bam, and removes the temp bams
+#The counts of all mapped reads are saved in a @CO line of the header, so that the full sam/bam does not need to be read again
+def write_candidates(cand_name, cand_temps, read_counts, opts):
+    temp = pysam.AlignmentFile(cand_temps[0])
+    if opts.nameSorted: sort_order = 'unsorted'
+    else: sort_order = 'coordinate'
+    header = {'HD':{'VN':'1.0', 'SO':sort_order}, 'SQ':[{'SN':r, 'LN':l} for r, l in zip(temp.references, temp.lengths)], 'CO':['chimeric_reads_counts:%s' % (json.dumps(counts_to_lists(read_counts)))]}
+    temp.close()
+    fout = pysam.AlignmentFile(cand_name, 'wb', header=header)
+    for cand_temp in cand_temps:
+        temp = pysam.AlignmentFile(cand_temp)
+        for read in temp.fetch(until_eof=True): fout.write(read)
+        temp.close()
+        os.remove(cand_temp)
+    fout.close()
+
+#Reads a bam of chimeric candidates written by write_candidates() and returns SA_info and read_counts, just like merge_alignments()
+def read_candidates(cand_name):
+    bam = pysam.AlignmentFile(cand_name)
+    for line in bam.text.split('\n'):
+        if line.startswith('@CO\tchimeric_reads_counts:'): read_counts = counts_from_lists(json.loads(line.split(':', 1)[1]))
+    SA_info = collections.OrderedDict()
+    #The counts of the candidates themselves are not needed
+    for read in bam.fetch(until_eof=True): add_alignment(read, SA_info, {}, new_read_counts())
+    bam.close()
+    return merge_alignments([[SA_info, read_counts, {}]])
+
+#read_counts with lists in place of the dicts, so that it can be saved as json without losing the order of the refs
+def counts_to_lists(read_counts):
+    lists = {}
+    for k in ['names', 'single_for', 'single_rev']: lists[k]=read_counts[k]
+    lists['ref_names'] = read_counts['ref_names'].items()
+    lists['single_aligned'] = [[ref, [[int(x[0]), int(x[1]), num] for x, num in hist.iteritems()]] for ref, hist in read_counts['single_aligned'].iteritems()]
+    return lists
+
+def counts_from_lists(lists):
+    read_counts = new_read_counts()
+    for k in ['names', 'single_for', 'single_rev']: read_counts[k]=lists[k]
+    for ref, num in lists['ref_names']: read_counts['ref_names'][str(ref)]=num
+    for ref, hist in lists['single_aligned']:
+        read_counts['single_aligned'][str(ref)]=collections.Counter(dict([((x[0], x[1]), x[2]) for x in hist]))
+    return read_counts
+
+#Combines the results of collect_alignments() for each region, in region order
+#A read with alignments in more than one region ends up with all of its alignments, in the order they appear in the bam
+def merge_alignments(results):
+    SA_info = {}
+    read_counts = new_read_counts()
+    pending = {}
+    for region_SA, region_counts, region_pending in results:
+        for read, info in region_SA.iteritems():
+            if read not in SA_info: SA_info[read]=[]
+            SA_info[read]+=info
+        read_counts['names']+=region_counts['names']
+        read_counts['single_for']+=region_counts['single_for']
+        read_counts['single_rev']+=region_counts['single_rev']
+        for ref, num in region_counts['ref_names'].iteritems():
+            if ref not in read_counts['ref_names']: read_counts['ref_names'][ref]=0
+            read_counts['ref_names'][ref]+=num
+        for ref, hist in region_counts['single_aligned'].iteritems():
+            if ref not in read_counts['single_aligned']: read_counts['single_aligned'][ref]=collections.Counter()
+            read_counts['single_aligned'][ref].update(hist)
+        #Reads with alignments in more than one region
+        for read, info in region_pending.iteritems():
+            if read not in pending: pending[read]=info
+            else:
+                pending[read][0]+=info[0]
+                for segment, num in info[1].iteritems():
+                    if num is not None or segment not in pending[read][1]: pending[read][1][segment]=num
+                for ref in info[2]:
+                    if ref not in pending[read][2]: pending[read][2].append(ref)
+                pending[read][4]+=info[4]
+            if read_complete(pending[read]): finish_read(pending.pop(read), read_counts)
+
+    #Anything left is missing some of its alignments (e.g., mates that were filtered out of the bam), so these are counted with the alignments that are present
+    for info in pending.values(): finish_read(info, read_counts)
+    return SA_info, read_counts
+
+#Running counts of all of the mapped reads (read names), which are used for the summary printed to the screen and in _chinfo.txt
+    #names = # of mapped read names, ref_names = # of read names mapped to each ref
+    #single_for/single_rev = # of read names with only one alignment, to the forward or reverse strand
+    #single_aligned = for each ref, # of read names with only one alignment, for each (# matched read bases, read length)
+        #R2 alignments with SA tags are not counted here, so a read name can also be included if its only other alignments are R2 chimeric alignments to the same ref
+def new_read_counts():
+    return {'names':0, 'ref_names':collections.OrderedDict(), 'single_for':0, 'single_rev':0, 'single_aligned':collections.OrderedDict()}
+
+#Adds one alignment to the counts, without keeping anything for the read name once all of its alignments have been seen
+#The # of alignments to expect for each read name is worked out from the flags (mate mapped?) and the SA tags (# of other alignments for the same read)
+#Reads that are still waiting for alignments are kept in pending: [# alignments seen, {segment: # alignments expected (None until it has been seen)}, [refs], is_reverse for the first alignment, [aligned for each alignment that has it]]
+def count_alignment(read, aligned, pending, read_counts):
+    if read.reference_name not in read_counts['ref_names']: read_counts['ref_names'][read.reference_name]=0
+    #0 = unpaired, 1 = R1, 2 = R2
+    if not read.is_paired: segment = 0
+    elif read.is_read1: segment = 1
+    else: segment = 2
+    if read.has_tag("SA"): expected = 1 + len([x for x in read.get_tag("SA").split(';') if x])
+    else: expected = 1
+    mate_mapped = read.is_paired and not read.mate_is_unmapped
+
+    #Most reads are the only alignment for their read name, so these are counted right away
+    if expected == 1 and not mate_mapped and read.query_name not in pending:
+        finish_read([1, {segment:1}, [read.reference_name], read.is_reverse, [x for x in [aligned] if x]], read_counts)
+        return
+
+    if read.query_name not in pending: pending[read.query_name]=[0, {}, [], read.is_reverse, []]
+    info = pending[read.query_name]
+    info[0]+=1
+    info[1][segment]=expected
+    if mate_mapped and 3-segment not in info[1]: info[1][3-segment]=None
+    if read.reference_name not in info[2]: info[2].append(read.reference_name)
+    if aligned: info[4].append(aligned)
+    if read_complete(info): finish_read(pending.pop(read.query_name), read_counts)
+
+def read_complete(info):
+    return None not in info[1].values() and info[0] == sum(info[1].values())
+
+def finish_read(info, read_counts):
+    read_counts['names']+=1
+    for ref in info[2]: read_counts['ref_names'][ref]+=1
+    if info[0] == 1:
+        if info[3]: read_counts['single_rev']+=1
+        else: read_counts['single_for']+=1
+    if len(info[2]) == 1 and len(info[4]) == 1:
+        if info[2][0] not in read_counts['single_aligned']: read_counts['single_aligned'][info[2][0]]=collections.Counter()
+        read_counts['single_aligned'][info[2][0]][info[4][0]]+=1
+
+#Turns a Counter of (# matched read bases, read length) into an array of the proportions of the read aligned and an array with the # of reads for each
+def hist_arrays(hist):
+    keys = sorted(hist.keys())
+    return np.array([x[0]/x[1] for x in keys], dtype=float), np.array([hist[x] for x in keys], dtype=int)
+
+def hist_mean(values, nums):
+    return (values*nums).sum()/nums.sum()
+
+def hist_std(values, nums):
+    return math.sqrt((nums*(values-hist_mean(values, nums))**2).sum()/nums.sum())
+
 #Returns a list with 3 values, # bases from the beginning of the read unaligned, num from middle and num from end
 def calcmissing(qsites_aligned, readlen):
-    begmiss = min(qsites_aligned)-0
-    midmiss = len(set(range(min(qsites_aligned), max(qsites_aligned)+1)).difference(set(qsites_aligned)))
-    endmiss = readlen-max(qsites_aligned)-1
+    begmiss = qsites_aligned[0][0]-0
+    midmiss = qsites_aligned[-1][1] - qsites_aligned[0][0] - intervals_len(qsites_aligned)
+    endmiss = readlen-qsites_aligned[-1][1]
     return [begmiss, midmiss, endmiss] 
 
-def flip(pairs, length):
-    new_pairs=[]
-    for q, r in pairs:
-        new_pairs.append((length-q-1, r))
-    return new_pairs
+#Returns an array with one row for each aligned (M, = or X) block of the cigar: [read start, ref start, length], and the length of the read
+#Read coordinates are the same as in read.get_aligned_pairs(matches_only=True), except that hard clipped bases are counted, just like soft clipped bases
+def aligned_blocks(read):
+    blocks=[]
+    q=0
+    r=read.reference_start
+    for t, l in read.cigartuples:
+        if t in (0, 7, 8):
+            if l: blocks.append([q, r, l])
+            q+=l
+            r+=l
+        elif t in (1, 4, 5): q+=l
+        elif t in (2, 3): r+=l
+    return np.array(blocks, dtype=np.int64).reshape(-1, 3), q
+
+#Returns an array with the [start, end] intervals of the read that are in the blocks, sorted by start
+#For reverse strand alignments, the read coordinates are flipped so that they can be compared with forward alignments of the same read
+def query_intervals(blocks, length, is_reverse):
+    if is_reverse: return np.column_stack((length-blocks[:,0]-blocks[:,2], length-blocks[:,0]))[::-1]
+    return np.column_stack((blocks[:,0], blocks[:,0]+blocks[:,2]))
+
+def blocks_len(blocks):
+    return blocks[:,2].sum()
+
+#Left and right most aligned ref positions
+def ref_min(blocks):
+    return blocks[0][1]
+
+def ref_max(blocks):
+    return blocks[-1][1]+blocks[-1][2]-1
+
+def ref_intervals(blocks):
+    return [[r, r+l] for q, r, l in blocks.tolist()]
+
+def intervals_len(intervals):
+    return sum([e-s for s, e in intervals])
+
+#Sorts and combines overlapping and adjacent [start, end] intervals
+def merge_intervals(intervals):
+    merged=[]
+    for s, e in sorted(intervals):
+        if merged and s <= merged[-1][1]: merged[-1][1]=max(merged[-1][1], e)
+        else: merged.append([s, e])
+    return merged
+
+#Removes the [start, end] intervals in remove from intervals
+def subtract_intervals(intervals, remove):
+    for rs, re in remove:
+        kept=[]
+        for s, e in intervals:
+            if re <= s or rs >= e: kept.append([s, e])
+            else:
+                if s < rs: kept.append([s, rs])
+                if re < e: kept.append([re, e])
+        intervals=kept
+    return intervals
 
 #!!!To check orientation of alignments
 def end_minus_start(pairs1, pairs2):
     #If the first alignment covers an earlier part of the read
-    if min([x[0] for x in pairs1]) < min([x[0] for x in pairs2]):
+    if pairs1[0][0] < pairs2[0][0]:
 #        print "1st Left"
-        max_read_base_ref = [x[1] for x in pairs2][-1]
-        min_read_base_ref = [x[1] for x in pairs1][0]
+        max_read_base_ref = ref_max(pairs2)
+        min_read_base_ref = ref_min(pairs1)
     else:
 #        print "1st Right"
-        max_read_base_ref = [x[1] for x in pairs1][-1]
-        min_read_base_ref = [x[1] for x in pairs2][0]
+        max_read_base_ref = ref_max(pairs1)
+        min_read_base_ref = ref_min(pairs2)
     return (max_read_base_ref - min_read_base_ref)
 
+#Returns the [start, end] intervals of the ref that are between the left and right most covered bases, but are not covered by either alignment
 def missing_bases(pairs1, pairs2):
-    ref1, ref2 = [x[1] for x in pairs1], [x[1] for x in pairs2]
-    full=range(min(ref1+ref2), max(ref1+ref2)+1)
-    covered = get_covered(pairs1, pairs2)
-    missing = list(set(full).difference(set(covered)))
-    #Added this section to remove any "missing bases" to the right of the right most mapped base.
+    missing = []
+    last = min(ref_min(pairs1), ref_min(pairs2))
+    #Only looking to the left of each covered interval means that there are never any "missing bases" to the right of the right most mapped base.
     #This is an issue for inverted alignments with multiply mapped bases
-    missing_inside = []
-    for each in missing:
-        if each < max(covered): missing_inside.append(each)
-#        else: print each, min(covered), max(covered)
-    return missing_inside
+    for s, e in get_covered(pairs1, pairs2):
+        if s > last: missing.append([last, s])
+        last = e
+    return missing
 
 #Currently using this to correct for query bases that are multiply mapped to the reference
-#Only the left most mapping is included in the output
+#Only the left most mapping is included in the output, which is a list of merged ref intervals
 def get_covered(pairs1, pairs2):
-    overlap = set([x[0] for x in pairs1]).intersection(set([x[0] for x in pairs2]))
-    if overlap:
-        d1 = dict(pairs1)
-        d2 = dict(pairs2)
-        for q, r in d2.iteritems():
-            if q not in d1: d1[q]=r
-            elif r<d1[q]: d1[q]=r
-        return sorted(d1.values())
-
-    else: return sorted(list(set([x[1] for x in pairs1]+[x[1] for x in pairs2])))
-
-def common_bases(cov1, cov2):
-    return list(set(cov1).intersection(set(cov2)))
-
-
-def corr_hardclipped(read):
-    length = read.infer_query_length()
-    for t, l in read.cigartuples:
-        if t==5: length+=l
-    pairs = read.get_aligned_pairs(matches_only=True)
-    if read.cigartuples[0][0]==5:
-        corr_pairs=[]
-        for q, r in pairs:
-            corr_pairs.append((q+read.cigartuples[0][1],r))
-        return corr_pairs, length
-    return pairs,length
-
-def get_aligned(tups, index):
+    drop1 = []
+    drop2 = []
+    for q1, r1, l1 in pairs1.tolist():
+        for q2, r2, l2 in pairs2.tolist():
+            s, e = max(q1, q2), min(q1+l1, q2+l2)
+            if s < e:
+                if r2-q2 < r1-q1: drop1.append([r1-q1+s, r1-q1+e])
+                else: drop2.append([r2-q2+s, r2-q2+e])
+    return merge_intervals(subtract_intervals(ref_intervals(pairs1), drop1) + subtract_intervals(ref_intervals(pairs2), drop2))
+
+#Returns the [start, end] intervals of the ref that are covered by both alignments
+def common_bases(pairs1, pairs2):
+    common=[]
+    for s1, e1 in ref_intervals(pairs1):
+        for s2, e2 in ref_intervals(pairs2):
+            s, e = max(s1, s2), min(e1, e2)
+            if s < e: common.append([s, e])
+    return merge_intervals(common)
+
+#Returns the merged intervals covered by any of the alignments and the total # of bases in all of the intervals
+def get_aligned(intervals):
     combo=[]
-    for each in tups:
-        combo+=[x[index] for x in each]
-    return list(set(combo)), combo
+    for each in intervals: combo+=each.tolist()
+    return merge_intervals(combo), intervals_len(combo)
 
 
 ###---For plotting
@@ -779,22 +1059,24 @@ def mid4leg(maxfreq):
 
 # will cut fasta name off at the first whitespace
 def read_fasta_lists_simple_names(file):
-    fin = open(file, 'r')
+    #Gzipped fastas (.gz) are decompressed as they are read
+    if file.endswith('.gz'): fin = gzip.open(file, 'rb')
+    else: fin = open(file, 'r')
     count=0
 
     names=[]
     seqs=[]
-    seq=''
+    seq=[]
     for line in fin:
         line=line.strip()
         if line and line[0] == '>':                #indicates the name of the sequence
             count+=1
             names.append(line[1:].split()[0])
             if count>1:
-                seqs.append(seq)
-            seq=''
-        else: seq +=line
-    seqs.append(seq)
+                seqs.append(''.join(seq))
+            seq=[]
+        else: seq.append(line)
+    seqs.append(''.join(seq))
 
     return names, seqs
 
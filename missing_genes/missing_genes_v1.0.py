@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 
 from __future__ import division
-import sys, optparse, os
+import sys, optparse, os, re, gzip
 from subprocess import Popen, PIPE
+import numpy as np
 
 def main():
     #To parse command line
@@ -19,7 +20,7 @@ def main():
 #    p.add_option('-g', '--genes', help='Gene info for the reference strain')
     p.add_option('--mapQ', type='int', default=20, help='Minimum mapping quality for a read to be used in the pileup generation for the non-repeat version [20]')
     p.add_option('--maxCov', type='int', default=500, help='Max per base coverage to be used in the pileup generation for the final quality check [500]')
-    p.add_option('--recursThresh', type='int', default=50000, help='Minimum level of coverage required to change consensus. [3000]')
+    p.add_option('--recursThresh', type='int', default=50000, help='No longer used, the pileup is parsed without recursion. Kept so that older command lines still work [50000]')
     p.add_option('--offset', type='int', default=33, help='Base quality offset used in the pileup. I believe the default in samtools is Sanger(33) [33]')
     p.add_option('--baseQual', type='int', default=20, help='Minimum base quality for a base to be counted when looking at coverage. [20]')
     p.add_option('--procs', type='int', default=1, help='Number of processors to use in multi-threaded portions [1]')
@@ -46,9 +47,6 @@ def main():
     #If both pileups are provided, automatically set justGenes = True
     if opts.std_pile and opts.qual_pile: opts.justGenes=True
 
-    #Increase recursion limit before starting script
-    sys.setrecursionlimit(opts.recursThresh)
-
     #This is probably not necessary in the current version, but shouldn't hurt
     #Change all filenames to their absolute path versions
     if opts.ref: opts.ref=os.path.abspath(opts.ref)
@@ -211,24 +209,23 @@ def get_pos_counts(pileup, opts):
     fin=open(pileup, 'r')
     for line in fin:
         chrom, pos, bases, indels, ends, quals = pileup_info(line)
-        #Removes info for bases with quality lower than the specified minimum threshold
-        good_bases, good_quals = quality_filter(bases, quals, opts)
-        ref_pos_dict_dict[chrom][pos]=len(good_bases)
-        non_zero_cov_counts.append(len(good_bases))
+        #Only counts bases with quality at or above the specified minimum threshold
+        good_depth=np.count_nonzero(quality_mask(quals, opts))
+        ref_pos_dict_dict[chrom][pos]=good_depth
+        non_zero_cov_counts.append(good_depth)
     #Just in case a whole contig doesn't have any coverage
 #    if not non_zero_cov_counts: non_zero_cov_counts=[1]
     return ref_pos_dict_dict, sum(non_zero_cov_counts)/len(non_zero_cov_counts)
 
 
-def quality_filter(bases, quals, opts):
-    new_bases=[]
-    new_quals=[]
-    for index in range(len(bases)):
-        if ord(quals[index])-opts.offset >= opts.baseQual:
-            new_bases.append(bases[index])
-            new_quals.append(quals[index])
-    return new_bases, new_quals
+#Base quality filter for all of the bases at a position at once. Returns True for each base with quality >= opts.baseQual
+def quality_mask(quals, opts):
+    return np.frombuffer(quals, dtype=np.uint8) >= opts.offset+opts.baseQual
+
 
+#To find read starts (with the associated mapping quality character) and indels in the bases column of a pileup
+read_starts=re.compile(r'\^.', re.DOTALL)
+indel_lengths=re.compile(r'([+-])([0-9]+)')
 
 def pileup_info(line):
     cols=line.strip().split('\t')
@@ -243,58 +240,37 @@ def pileup_info(line):
 def parse_bases(raw_bases, num_reads):
     #If any reads begin at this position, remove these markers and the associated mapping quality info
     if '^' in raw_bases:
-        bases=remove_beg_info(raw_bases)
+        bases=read_starts.sub('', raw_bases)
     else: bases=raw_bases
     #Count the number of reads ending and then remove the $ charcters
     ends=bases.count('$')
-    bases=bases.replace('$', '')
-
+    if ends: bases=bases.replace('$', '')
+    
     #Get info about indels following this position and remove this info form bases
     indels={}           #This line is needed to ensure an empty dict named indels for strings without indel present
     if '-' in bases or '+' in bases:
-        bases, indels = indel_info(bases, indels)
-
+        bases, indels = indel_info(bases)
+    
     if len(bases)==num_reads: return bases, indels, ends
     else:
         print 'Problem!!! Exp bases: %d, Output bases: %d, Input str: %s, Output str: %s' % (num_reads, len(bases), raw_bases, bases)
         return #This will cause script to stop because three arguments are expected to be returned
 
-def remove_beg_info(bases):
-    while '^' in bases:
-        index=bases.index('^')
-        bases=bases[:index]+bases[index+2:]
-    return bases
-
-def indel_info(bases, ind_dict):
+#Single scan through the bases, no recursion. Runs of bases between indels are copied over as slices
+#Indel sequences never contain +, - or digits, so every match is the start of a new indel
+def indel_info(bases):
     ind_dict={}
-    if '-' in bases:
-        del_info=[]
-        new_bases, del_info = characterize_indel(bases, '-', del_info)
-        ind_dict['delete']=del_info
-        bases=new_bases
-    if '+' in bases:
-        ins_info=[]
-        new_bases, ins_info = characterize_indel(bases, '+', ins_info)
-        ind_dict['insert']=ins_info
-        bases=new_bases
-    return bases, ind_dict
-
-def characterize_indel(bases, type_char, ind_info):
-    start_index=bases.index(type_char)
-    digitcount=0
-    for each in bases[start_index+1:]:
-        if each.isdigit(): digitcount+=1
-        else: break
-    indel_bases=int(bases[start_index+1:start_index+1+digitcount])
-    indel_str=bases[start_index+1+digitcount:start_index+1+digitcount+indel_bases]
-
-    ind_info.append(indel_str)
-    bases=bases[:start_index]+bases[start_index+1+digitcount+indel_bases:]
-    #Recursively go through this process if the string has more indel info
-    if type_char in bases: bases, ind_info = characterize_indel(bases, type_char, ind_info)
-
-    return bases, ind_info
-
+    new_bases=[]
+    index=0
+    for indel in indel_lengths.finditer(bases):
+        new_bases.append(bases[index:indel.start()])
+        index=indel.end()+int(indel.group(2))
+        if indel.group(1)=='-': indel_type='delete'
+        else: indel_type='insert'
+        if indel_type not in ind_dict: ind_dict[indel_type]=[]
+        ind_dict[indel_type].append(bases[indel.end():index])
+    new_bases.append(bases[index:])
+    return ''.join(new_bases), ind_dict
 
 
 def comma_sep_abs_path(string):
@@ -322,21 +298,23 @@ def make_gen_info_file(reference):
 
 # Extracts data from a fasta sequence file. Returns two lists, the first holds the names of the seqs (
 def read_fasta_lists_simple(file):
-    fin = open(file, 'r')
+    #Gzipped fastas (.gz) are decompressed as they are read
+    if file.endswith('.gz'): fin = gzip.open(file, 'rb')
+    else: fin = open(file, 'r')
     count=0
     names=[]
     seqs=[]
-    seq=''
+    seq=[]
     for line in fin:
         line=line.strip()
         if line and line[0] == '>':                #indicates the name of the sequence
             count+=1
             names.append(line[1:].split()[0])
             if count>1:
-                seqs.append(seq)
-            seq=''
-        else: seq +=line
-    seqs.append(seq)
+                seqs.append(''.join(seq))
+            seq=[]
+        else: seq.append(line)
+    seqs.append(''.join(seq))
                                                                                                                                                                                                                                         
     return names, seqs
 
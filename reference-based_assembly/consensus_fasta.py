@@ -24,8 +24,10 @@
 
 
 from __future__ import division
-import sys, optparse, os, glob
-from subprocess import Popen, PIPE
+import sys, optparse, os, re, glob, itertools, multiprocessing, copy, time, traceback, Queue, collections, hashlib, shutil, fcntl, mmap, signal, heapq
+from cStringIO import StringIO
+from subprocess import Popen, PIPE, STDOUT
+from distutils.spawn import find_executable
 from Bio.Seq import Seq
 from Bio.Alphabet import generic_dna
 import numpy as np
@@ -49,19 +51,28 @@ def main():
 
     
     #General
-    p.add_option('--recursThresh', type='int', default=50000, help='Minimum level of coverage required to change consensus. [3000]')
+    p.add_option('--recursThresh', type='int', default=50000, help='No longer used, the pileup is parsed without recursion. Kept so that older command lines still work [50000]')
+    p.add_option('--cacheDir', help='Directory for saving the outputs of each step (trimming, alignment, sorting, dedup, pileup), keyed by a checksum of their inputs and settings. When the script is run again with the same reads and reference, finished steps are restored from here instead of being rerun, so only the changed steps (e.g., the consensus with new thresholds) are run. Outputs from the cache are only copied into the working directory when a step that is run needs them [None]')
     p.add_option('--temp', help='Name for working directory that will hold internediate files. This is not currently being cleaned [based on -o]')
     p.add_option('--procs', type='int', default=2, help='Number of processors to use in multi-threaded portions [2]')
+    p.add_option('--samples', type='int', default=1, help='Number of samples to run at once in the batch modes (multiple bams, -i, or comma separated --bam/--out). --procs is split evenly between the samples that are running [1]')
+    p.add_option('--gzipFastq', default=False, action='store_true', help='Use this flag to keep all of the intermediate fastqs gzipped. pigz or igzip are used for (de)compression if they are in your $PATH [False]')
+    p.add_option('--concurrentMates', default=False, action='store_true', help='Use this flag to run the R1 and R2 steps of the read trimming (cutadapt and hard clipping) at the same time. Uses up to 2 of --procs [False]')
+    p.add_option('--parallelContigs', default=False, action='store_true', help='Use this flag to make the consensus for each contig in a separate process, using up to --procs processes at once. Useful for references with many contigs [False]')
     p.add_option('--Nbeg', type='int', default=0, help='# of Ns to add to the beginning of each contig [0]')
     p.add_option('--Nend', type='int', default=0, help='# of Ns to add to the beginning of each contig [0]')    
     
     #For samtools
     p.add_option('--mapQ', type='int', default=10, help='Minimum mapping quality for a read to be used in the pileup generation [10]')
     p.add_option('--maxCov', type='int', default=300, help='Max per base coverage to be used in the pileup generation [300]')
+    p.add_option('--streamAlign', default=False, action='store_true', help='Use this flag to pipe the bowtie2 output straight into samtools sort, instead of writing an unsorted bam and then sorting it. Only used when starting from reads [False]')
     #This step allows for a large amount of time saved when a small number of the reads actually map to the reference. Should probably be used for viral samples, but not bacterial.
-    p.add_option('--NOonlyMapped', default=False, action='store_true', help='Use this flag to turn off the part of the script that creates a smaller sam with only mapped reads prior to sorting')
+    p.add_option('--NOonlyMapped', default=False, action='store_true', help='Use this flag to turn off the part of the script that drops unmapped reads prior to sorting (samtools view -F 4 in the pipe into samtools sort)')
+    #Skips writing the .pile file. The same mapQ, maxCov, baseQual and anomalous pair settings are used
+    p.add_option('--pysamPile', default=False, action='store_true', help='Use this flag to make the pileup in process with pysam, directly from the sorted bam, instead of writing and then reading a samtools mpileup file. Requires pysam [False]')
     
     #For bowtie2
+    p.add_option('--indexCache', help='Directory for keeping bowtie2 indexes, keyed by a checksum of the reference (including any Ns added with --Nbeg/--Nend). Each index is only built once and is then shared by all samples and later runs [None]')
     p.add_option('--nceil', default='0,0.3',  help='Function to supply as --n-ceil parameter in bowtie2. [0,0.3]')
     p.add_option('--minIns', type='int', default=0, help='Minimum insert size for a pair to be concordant [0]')
     p.add_option('--maxIns', type='int', default=500, help='Maximum insert size for a pair to be concordant [500]')
@@ -77,6 +88,7 @@ def main():
     p.add_option('--ca', default='cutadapt', help='How to call cutadapt. Need to use version >=1.2 [cutadapt]')
     p.add_option('--ps', default='prinseq-lite_0.20.3.pl', help='How to call prinseq. [prinseq-lite-0.20.3.pl]')
     p.add_option('--pc', default='~/programs/picard.jar', help='How to call picard.jar. [~/programs/picard.jar]')
+    p.add_option('--dedup', default='picard', type='choice', choices=['picard', 'markdup', 'pysam'], help='How to remove duplicates. picard = picard MarkDuplicates, markdup = samtools fixmate + markdup (needs samtools >=1.6), pysam = in this script, in one pass over the bam, with rules like picard (the 5 prime ends and strands of both reads, but no optical duplicates or libraries) (needs pysam). All three write a picard style _metrics.txt [picard]')
 #    p.add_option('--tr', default='~/programs/trimmomatic-0.33.jar', help='How to call trimmomatic. [~/programs/trimmomatic-0.33.jar]')
     p.add_option('--i1', default='GATCGGAAGAGCACACGTCTGAACTCCAGTCAC', help="Illumina adaptor to be trimmed from the 3' end of R1. [GATCGGAAGAGCACACGTCTGAACTCCAGTCAC]")
     p.add_option('--i2', default='AGATCGGAAGAGCGTCGTGTAGGGAAAGAGTGT', help='Reverse complement of the Illumina adaptor that will be trimmed from the 3; end of R2 [AGATCGGAAGAGCGTCGTGTAGGGAAAGAGTGT')
@@ -94,19 +106,25 @@ def main():
 
     #To turn off different parts of the pipeline
 #    p.add_option('--NOtrimmomatic', default=False, action='store_true', help='Use this flag to turn off the part of the script that runs trimmomatic')
+    #Needs a version of cutadapt with paired end support (-A and --interleaved, >=1.10)
+    p.add_option('--pairedTrim', default=False, action='store_true', help='Use this flag to run cutadapt in paired end mode, with the hard clipping (--hc) done on its output as it is read. Replaces the separate cutadapt, re-pairing and hard clipping steps [False]')
     p.add_option('--NOcutadapt', default=False, action='store_true', help='Use this flag to turn off the part of the script that runs cutadapt')
     p.add_option('--NOprinseq', default=False, action='store_true', help='Use this flag to turn off the part of the script that runs prinseq')
-    p.add_option('--NOpicard', default=False, action='store_true', help='Use this flag to turn off the part of the script that runs picard')
+    p.add_option('--NOpicard', default=False, action='store_true', help='Use this flag to turn off the part of the script that removes duplicates (with picard or --dedup)')
 
 
     opts, args = p.parse_args()
 
+    #samtools markdup (and the sort -o used with it) are only in samtools >=1.6, so check before starting any of the samples
+    if opts.dedup == 'markdup' and not opts.NOpicard:
+        version=samtools_version()
+        if version < (1, 6):
+            print '--dedup markdup needs samtools >=1.6, but the samtools in your $PATH is version %s. Use --dedup picard or --dedup pysam instead!!!!' % ('.'.join([str(x) for x in version]) or 'unknown')
+            return
+
     opts.index1=''
     opts.index2=''
     
-    #Increase recursion limit before starting script
-    sys.setrecursionlimit(opts.recursThresh)
-    
     #To allow for trimming multiple sispa like sequences (trimmed from both sides of reads), this function replaces the sequences with the string that will go into the cutadapt command
     if opts.sispa:
         opts.sispa=make_sispa_str(opts.sispa)
@@ -114,17 +132,20 @@ def main():
 
     #If providing multiple bams as args. Output names will be taken from bam names
     if args:
+        sample_opts=[]
         for bamfile in args:
             opts.bam=bamfile
             opts.out='.'.join(bamfile.split('.')[:-1])
             opts.temp=None
-            run_iteration(opts)
+            sample_opts.append(copy.copy(opts))
+        run_samples(sample_opts, opts)
 
 
     #If you are running multiple samples from fastqs
     elif opts.input:
         finin = open(opts.input, 'r')
         start_ref=opts.ref
+        sample_opts=[]
         for line in finin:
             #This resting of the ref is important if you are adding Ns onto the ends of the ref
             opts.ref=start_ref
@@ -138,7 +159,9 @@ def main():
                 opts.index2=','.join(sorted(glob.glob('%s*I2*' % cols[1])))
             if len(cols)>2: opts.ref=cols[2]
             print opts.paired1, opts.paired2, opts.ref
-            run_iteration(opts)
+            opts.temp=None
+            sample_opts.append(copy.copy(opts))
+        run_samples(sample_opts, opts)
 
     #If you are running multiple bam files
     elif ',' in opts.out:
@@ -146,11 +169,13 @@ def main():
         if opts.bam:
             bam_list=opts.bam.split(',')
             if len(bam_list) == len(out_list):
+                sample_opts=[]
                 for i in range(len(out_list)):
                     opts.out=out_list[i]
                     opts.bam=bam_list[i]
                     opts.temp=None
-                    run_iteration(opts)
+                    sample_opts.append(copy.copy(opts))
+                run_samples(sample_opts, opts)
             else: print 'Must provide the same number of input files and output names!!!!'
     
     #If you are running just one bam file or something else
@@ -158,15 +183,95 @@ def main():
 
 ###-----------------End of main()--------------------------->>>
 
+###-----------Start of functions for running multiple samples-----------
+
+#Runs each sample in sample_opts (one copy of opts per sample), with up to opts.samples running at once, and then writes a summary table
+#Each sample runs in its own process, so the os.chdir into each sample's temp directory does not affect the others
+def run_samples(sample_opts, opts):
+    start_dir=os.getcwd()
+    summary=[]
+    
+    if opts.samples<=1:
+        for index, each in enumerate(sample_opts): summary.append([index, run_sample(each)])
+    
+    else:
+        #Split the threads for bowtie2, picard, etc. between the samples that are running at the same time
+        for each in sample_opts: each.procs=max(1, opts.procs//opts.samples)
+        #Read the references here, so that the sample processes share one copy instead of each reading their own
+        #Not done for --Nbeg/--Nend, because then each sample makes its own padded reference in its temp directory
+        if not opts.Nbeg and not opts.Nend:
+            for ref in set([each.ref for each in sample_opts]):
+                if ref and os.path.isfile(ref): load_ref(os.path.abspath(ref))
+        results=multiprocessing.Queue()
+        running={}
+        waiting=list(enumerate(sample_opts))
+        while waiting or running:
+            #Start new samples as soon as there is room
+            while waiting and len(running)<opts.samples:
+                index, each = waiting.pop(0)
+                #Not a daemon process, so --parallelContigs can still start its own pool
+                proc=multiprocessing.Process(target=sample_worker, args=(index, each, results))
+                proc.start()
+                running[index]=[proc, each]
+            try:
+                index, row = results.get(timeout=10)
+                summary.append([index, row])
+                running[index][0].join()
+                del(running[index])
+            #Check for samples that died without reporting back
+            except Queue.Empty:
+                for index, (proc, each) in running.items():
+                    if not proc.is_alive() and proc.exitcode != 0:
+                        summary.append([index, [each.out, 'Failed', 'NA', 'NA']])
+                        del(running[index])
+    
+    #Samples are listed in the same order they were provided
+    write_summary([row for index, row in sorted(summary)], '%s/consensus_summary.txt' % start_dir)
+
+#Called in a separate process for each sample when running multiple samples at once
+def sample_worker(index, opts, results):
+    results.put([index, run_sample(opts)])
+
+#Runs a single sample and returns a row for the summary table: [name, status, # changes, time in minutes]
+def run_sample(opts):
+    start=time.time()
+    start_dir=os.getcwd()
+    try:
+        num_changes=run_iteration(opts)
+        status='Done'
+    #Report the problem, but keep going with the other samples
+    except Exception:
+        traceback.print_exc()
+        os.chdir(start_dir)
+        num_changes='NA'
+        status='Failed'
+    return [opts.out, status, num_changes, '%.1f' % ((time.time()-start)/60)]
+
+def write_summary(summary, summary_name):
+    fout=open(summary_name, 'w')
+    fout.write('Sample\tStatus\t#Changes\tMinutes\n')
+    print '\nSample\tStatus\t#Changes\tMinutes'
+    for row in summary:
+        line='\t'.join([str(x) for x in row])
+        fout.write('%s\n' % line)
+        print line
+    fout.close()
+
+###-----------End of functions for running multiple samples-----------
+
 def make_sispa_str(seqs_comma):
     cut_str=''
     for seq in seqs_comma.split(','):
         cut_str+=' -g sispaF=%s -a sispaR=%s ' % (seq, rev_comp(seq))
     return cut_str
 
-def concat_fastqs(fastq_str, newname):
+#With --gzipFastq the gzipped fastqs are just joined, because concatenated gzip files are still a valid gzip file
+def concat_fastqs(fastq_str, newname, opts):
     fastqs=fastq_str.split(',')
-    cmd='zcat %s >%s' % (' '.join(fastqs), newname)
+    if opts.gzipFastq and all([x.endswith('.gz') for x in fastqs]):
+        newname='%s.gz' % newname
+        cmd='cat %s >%s' % (' '.join(fastqs), newname)
+    else: cmd='zcat -f %s >%s' % (' '.join(fastqs), newname)
     print cmd
     concat=Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
     concat.wait()
@@ -174,29 +279,32 @@ def concat_fastqs(fastq_str, newname):
 
 
 def run_iteration(opts):
+    if opts.cacheDir: opts.cacheDir=os.path.abspath(opts.cacheDir)
+    if opts.indexCache: opts.indexCache=os.path.abspath(opts.indexCache)
+    
     #Concatenate fastqs, if multiple
     #And set to absolute path
     if opts.paired1:
         if ',' in opts.paired1:
-            opts.paired1=concat_fastqs(opts.paired1, '%s_R1.fastq' % (opts.out))
+            opts.paired1=cached_stage('concat', opts.paired1.split(','), [opts.gzipFastq], opts, concat_fastqs, opts.paired1, '%s_R1.fastq' % (opts.out), opts)
         opts.paired1=os.path.abspath(opts.paired1)
     if opts.paired2:
         if ',' in opts.paired2:
-            opts.paired2=concat_fastqs(opts.paired2, '%s_R2.fastq' % (opts.out))
+            opts.paired2=cached_stage('concat', opts.paired2.split(','), [opts.gzipFastq], opts, concat_fastqs, opts.paired2, '%s_R2.fastq' % (opts.out), opts)
         opts.paired2=os.path.abspath(opts.paired2)
     
     if opts.index1:
         if ',' in opts.index1:
-            opts.index1=concat_fastqs(opts.index1, '%s_I1.fastq' % (opts.out))
+            opts.index1=cached_stage('concat', opts.index1.split(','), [opts.gzipFastq], opts, concat_fastqs, opts.index1, '%s_I1.fastq' % (opts.out), opts)
         opts.index1=os.path.abspath(opts.index1)
     if opts.index2:
         if ',' in opts.index2:
-            opts.index2=concat_fastqs(opts.index2, '%s_I2.fastq' % (opts.out))
+            opts.index2=cached_stage('concat', opts.index2.split(','), [opts.gzipFastq], opts, concat_fastqs, opts.index2, '%s_I2.fastq' % (opts.out), opts)
         opts.index2=os.path.abspath(opts.index2)
     
     #Index filter, if requested
     if opts.indexFilt:
-        opts.paired1, opts.paired2 = filter_index(opts)
+        opts.paired1, opts.paired2 = cached_stage('index_filter', [opts.paired1, opts.paired2, opts.index1, opts.index2], [opts.indexFilt, opts.offset, opts.gzipFastq], opts, filter_index, opts)
         opts.paired1=os.path.abspath(opts.paired1)
         opts.paired2=os.path.abspath(opts.paired2)
 
@@ -214,83 +322,168 @@ def run_iteration(opts):
     opts.startDir=os.getcwd()
     
     #Create consensus
-    create_consensus(opts)
+    num_changes = create_consensus(opts)
     
     #Added this line so that if running multiple analyses at once
     opts.temp=None
-
+    
+    return num_changes
+
+
+###-----------Start of functions for the stage cache (--cacheDir)-----------
+
+#Checksums of files that have already been read, or that were made by a cached stage, by (path, size, modification time)
+file_keys={}
+
+#Outputs of stages that were found in the cache, but that haven't been copied out yet: path -> (stage directory, key)
+cached_files={}
+
+#md5 of the file contents
+def file_key(name):
+    name=os.path.abspath(name)
+    if name in cached_files: return cached_files[name][1]
+    info=os.stat(name)
+    id=(name, info.st_size, info.st_mtime)
+    if id not in file_keys:
+        md5=hashlib.md5()
+        fin=open(name, 'rb')
+        for block in iter(lambda: fin.read(1048576), ''): md5.update(block)
+        fin.close()
+        file_keys[id]=md5.hexdigest()
+    return file_keys[id]
+
+def set_file_key(name, key):
+    name=os.path.abspath(name)
+    info=os.stat(name)
+    file_keys[(name, info.st_size, info.st_mtime)]=key
+
+#Returns func(*args), which must return the name of the file it made or a list/tuple of names, or None if it failed
+#With --cacheDir, the step is keyed by its name, the contents of the input files and its parameters
+#If the key is already in the cache, func is not run, and the outputs are only copied into place (by restore_cached) when a step that isn't in the cache needs them
+#So when only the last steps change, none of the earlier outputs are copied out. Otherwise the outputs are copied into the cache after running func
+#Other files whose names start with the name of an output (e.g., .bai indexes, picard metrics) are kept with it
+#The files are copied rather than hard linked, because the steps overwrite their outputs in place (open(x, 'w'), >x), which would also change a linked cache entry when a step is rerun with different settings
+def cached_stage(name, inputs, params, opts, func, *args):
+    if not opts.cacheDir: return func(*args)
+    
+    inputs=[x for x in inputs if x]
+    key=hashlib.md5('\t'.join([name] + [file_key(x) for x in inputs] + [repr(x) for x in params])).hexdigest()
+    stage_dir=os.path.join(opts.cacheDir, '%s_%s' % (name, key))
+    
+    if os.path.isfile(os.path.join(stage_dir, 'outputs.txt')):
+        print 'Found %s in %s' % (name, stage_dir)
+        fin=open(os.path.join(stage_dir, 'outputs.txt'), 'r')
+        kind=fin.readline().strip()
+        outputs=[os.path.abspath(line.strip()) for line in fin]
+        fin.close()
+        #Outputs of cached stages get keys based on the stage key, so they don't need to be read (or even copied out) to get their checksum
+        for output in outputs: cached_files[output]=(stage_dir, output_key(key, output))
+    else:
+        restore_cached(*inputs)
+        result=func(*args)
+        if not result: return result
+        if isinstance(result, str): kind, outputs = 'str', [result]
+        else: kind, outputs = 'list', list(result)
+        
+        #The outputs are put in a temporary directory first, so that a stage is only in the cache once it is complete
+        if not os.path.isdir(opts.cacheDir): os.makedirs(opts.cacheDir)
+        temp_dir='%s.tmp%d' % (stage_dir, os.getpid())
+        os.mkdir(temp_dir)
+        fout=open(os.path.join(temp_dir, 'outputs.txt'), 'w')
+        fout.write('%s\n' % kind)
+        for output in outputs:
+            fout.write('%s\n' % output.split('/')[-1])
+            for each in glob.glob('%s*' % output):
+                copy_file(each, os.path.join(temp_dir, each.split('/')[-1]))
+        fout.close()
+        try: os.rename(temp_dir, stage_dir)
+        #Another sample already saved the same stage
+        except OSError: shutil.rmtree(temp_dir)
+        for output in outputs:
+            cached_files.pop(os.path.abspath(output), None)
+            set_file_key(output, output_key(key, output))
+    
+    if kind == 'str': return outputs[0]
+    else: return outputs
+
+def output_key(stage_key, output):
+    return hashlib.md5('%s\t%s' % (stage_key, output.split('/')[-1])).hexdigest()
+
+#Copies outputs of stages that were found in the cache (and the files kept with them) into place. Must be called before a file from cached_stage is read by anything other than another cached stage
+def restore_cached(*names):
+    for name in names:
+        if not name: continue
+        name=os.path.abspath(name)
+        if name not in cached_files: continue
+        stage_dir, key = cached_files.pop(name)
+        print 'Restoring %s from %s' % (name.split('/')[-1], stage_dir)
+        for each in glob.glob(os.path.join(stage_dir, '%s*' % name.split('/')[-1])):
+            copy_file(each, os.path.join(os.path.dirname(name), each.split('/')[-1]))
+        set_file_key(name, key)
+
+#Any existing dest is removed first, so that a file it is hard linked to (e.g., from an older version of the cache) is not changed
+def copy_file(src, dest):
+    if os.path.abspath(src) == os.path.abspath(dest): return
+    if os.path.exists(dest): os.remove(dest)
+    shutil.copy2(src, dest)
+
+###-----------End of functions for the stage cache-----------
 
 #Index filter scripts--------------------
 
-def filter_index(opts):
+#The reads are handled in chunks of chunk_size records, and the mean index qualities are checked for a whole chunk at once
+def filter_index(opts, chunk_size=100000):
     
     #Open new output files
-    fout_r1 = open('%s_R1_Q%d.fastq' % (opts.out, opts.indexFilt), 'w')
-    fout_r2 = open('%s_R2_Q%d.fastq' % (opts.out, opts.indexFilt), 'w')
+    out_r1 = fastq_name('%s_R1_Q%d' % (opts.out, opts.indexFilt), opts)
+    out_r2 = fastq_name('%s_R2_Q%d' % (opts.out, opts.indexFilt), opts)
+    fout_r1 = fastq_open(out_r1, 'w', opts.procs)
+    fout_r2 = fastq_open(out_r2, 'w', opts.procs)
 #    fout_i1 = open('%s_Q%d.fastq' % (opts.I1.split('.')[0], opts.minQual), 'w')
 #    fout_i2 = open('%s_Q%d.fastq' % (opts.I2.split('.')[0], opts.minQual), 'w')
     #Open input fastq files
-    fin_r1 = open(opts.paired1, 'r')
-    fin_r2 = open(opts.paired2, 'r')
-    fin_i1 = open(opts.index1, 'r')
-    fin_i2 = open(opts.index2, 'r')
+    fin_r1 = fastq_open(opts.paired1)
+    fin_r2 = fastq_open(opts.paired2)
+    fin_i1 = fastq_open(opts.index1)
+    fin_i2 = fastq_open(opts.index2)
+    #Each item is a tuple with the R1, R2, I1 and I2 records (each a tuple of four lines) for one cluster
+    all_reads=itertools.izip(*[itertools.izip(x, x, x, x) for x in [fin_r1, fin_r2, fin_i1, fin_i2]])
     
 #    good_index_count=0
     while 1:
-        first_mate=[]
-        second_mate=[]
-        first_index=[]
-        second_index=[]
-        #Extract a single sequence from each read file
-        for i in range(4):
-            first_mate.append(fin_r1.readline())
-            second_mate.append(fin_r2.readline())
-            first_index.append(fin_i1.readline())
-            second_index.append(fin_i2.readline())
-            
-        if first_mate[0]=='': 
-            #Close all open files
-            fout_r1.close()
-            fout_r2.close()
-#            fout_i1.close()
-#            fout_i2.close()
-            fin_r1.close()
-            fin_r2.close()
-            fin_i1.close()
-            fin_i2.close()
-            return '%s_R1_Q%d.fastq' % (opts.out, opts.indexFilt), '%s_R2_Q%d.fastq' % (opts.out, opts.indexFilt)
-        else: 
-            if good_qual(first_index[3], opts.indexFilt, opts.offset) and good_qual(second_index[3], opts.indexFilt, opts.offset):
-#                good_index_count+=1
-                fout_r1.writelines(first_mate)
-                fout_r2.writelines(second_mate)
-#                fout_i1.writelines(first_index)
-#                fout_i2.writelines(second_index)
+        chunk=list(itertools.islice(all_reads, chunk_size))
+        if not chunk: break
+        first_mate, second_mate, first_index, second_index = zip(*chunk)
+        keep=np.flatnonzero(good_quals(first_index, opts.indexFilt, opts.offset) & good_quals(second_index, opts.indexFilt, opts.offset))
+#        good_index_count+=len(keep)
+        fout_r1.writelines([''.join(first_mate[x]) for x in keep])
+        fout_r2.writelines([''.join(second_mate[x]) for x in keep])
 #    print 'Number of good pairs remaining: %d' % (good_index_count)
 
-    return '%s_R1_Q%d.fastq' % (opts.out, opts.indexFilt), '%s_R2_Q%d.fastq' % (opts.out, opts.indexFilt)
-
-def good_qual(index_quals, min_qual, offset):
-    index_quals=[ord(x)-offset for x in index_quals.strip()]
-    if np.average(index_quals)>=min_qual: return True
-    else: return False
+    #Close all open files
+    fastq_close(fout_r1, fout_r2, fin_r1, fin_r2, fin_i1, fin_i2)
+    return out_r1, out_r2
+
+#Returns a bool array with True for each index read with a mean quality >= min_qual
+#All of the quality strings are decoded into one numpy array, and the scores for each read are summed with reduceat, which also works if the index reads differ in length
+def good_quals(index_reads, min_qual, offset):
+    quals=[x[3].strip() for x in index_reads]
+    lengths=np.array([len(x) for x in quals])
+    good=np.zeros(len(quals), bool)
+    has_quals=lengths>0
+    if has_quals.any():
+        starts=(np.cumsum(lengths)-lengths)[has_quals]
+        sums=np.add.reduceat(np.frombuffer(''.join(quals), np.uint8), starts, dtype=np.int64)
+        good[has_quals]=(sums-offset*lengths[has_quals])/lengths[has_quals]>=min_qual
+    return good
     
 ###---------End of index filter scripts---------------
 
-def quality_filter(bases, quals, opts):
-    new_bases=[]
-    new_quals=[]
-    for index in range(len(bases)):
-        if ord(quals[index])-opts.offset >= opts.baseQual:
-            new_bases.append(bases[index])
-            new_quals.append(quals[index])
-    return new_bases, new_quals
-
-
 def create_consensus(opts):
 
     #Create temporary working direcory and move to that directory
-    os.mkdir(opts.temp)
+    #With --cacheDir, the working directory of an earlier run can be reused
+    if not opts.cacheDir or not os.path.isdir(opts.temp): os.mkdir(opts.temp)
     os.chdir(opts.temp)
 
     if opts.Nbeg or opts.Nend:
@@ -298,6 +491,7 @@ def create_consensus(opts):
         opts.ref=Ns_ref
     else: Ns_ref='fake_name_that_hopefully_wont_match_a_real_file'
 
+    bam, pileup = None, None
     
     #If you are staring with reads that need to be mapped
     if not opts.pile and not opts.bam and not opts.sam:
@@ -307,11 +501,16 @@ def create_consensus(opts):
 #        if not opts.NOtrimmomatic:
             
         
+        #Adapter trimming, length filtering and hard clipping in a single pass, with only the surviving pairs written out
+        if opts.pairedTrim and not opts.NOcutadapt:
+            opts.paired1, opts.paired2 = cached_stage('paired_trim', [opts.paired1, opts.paired2], [opts.ca, opts.i1, opts.i2, opts.sispa, opts.minLength, opts.hc, opts.gzipFastq], opts, paired_trim, opts)
+            opts.paired1=os.path.abspath(opts.paired1)
+            opts.paired2=os.path.abspath(opts.paired2)
+        
         #Run Cutadapt, unless NOcutadapt flag was thrown
-        if not opts.NOcutadapt:
+        elif not opts.NOcutadapt:
             #Run cutadapt
-            one_cut, one_info_file = run_cutadapt(opts.paired1, opts.i1, opts)
-            two_cut, two_info_file = run_cutadapt(opts.paired2, opts.i2, opts)
+            one_cut, two_cut = cached_stage('cutadapt', [opts.paired1, opts.paired2], [opts.ca, opts.i1, opts.i2, opts.sispa, opts.minLength, opts.gzipFastq], opts, run_cutadapt, opts)
 
             #Delete random primers associated with sispa adapters
 #            if opts.num:
@@ -322,44 +521,40 @@ def create_consensus(opts):
 #                two_cut=two_cut_trim
 
             #Make new fastqs with just reads that are still paired. Delete intermediate files
-            opts.paired1, opts.paired2 = paired_sort(one_cut, two_cut)
+            start=time.time()
+            opts.paired1, opts.paired2 = cached_stage('pairing', [one_cut, two_cut], [opts.gzipFastq], opts, paired_sort, one_cut, two_cut, opts)
+            log_step_time('paired_sort', start)
             opts.paired1=os.path.abspath(opts.paired1)
             opts.paired2=os.path.abspath(opts.paired2)
             delete_files(one_cut, two_cut)
 
         #Hard clip a defined number of bases from the beginning of R1 and the end of R2, if specified
         #This is to make sure to get rid of any random mer incorporated during library prep
-        if opts.hc:
-            opts.paired1, opts.paired2 = hard_clip(opts)
+        if opts.hc and (opts.NOcutadapt or not opts.pairedTrim):
+            opts.paired1, opts.paired2 = cached_stage('hard_clip', [opts.paired1, opts.paired2], [opts.ps, opts.hc, opts.gzipFastq], opts, hard_clip, opts)
 
         #Run prinseq, unless NOprinseq flag was thrown
         if not opts.NOprinseq:
-            opts.paired1, opts.paired2 = paired_prinseq(opts)
+            opts.paired1, opts.paired2 = cached_stage('prinseq', [opts.paired1, opts.paired2], [opts.ps, opts.minLength, opts.trimQual, opts.trimType, opts.trimWin, opts.meanQual, opts.gzipFastq], opts, paired_prinseq, opts)
         
         #Add Ns to the beginning and ends of contigs if specified. Ns_ref variable makes it easy to remove this temporary file at the end
         #First alignment of reads to reference with bowtie2
-        sam = bowtie2_index_align(opts.ref, opts)
+        if opts.streamAlign: bam, pileup = stream_align_sort_pileup(opts.ref, opts)
+        else: bam = cached_stage('align_bam', [opts.ref, opts.unpaired, opts.paired1, opts.paired2], [opts.nceil, opts.minIns, opts.maxIns], opts, bowtie2_index_align, opts.ref, opts)
     
-    if not opts.pile and not opts.bam:
-        if opts.sam: sam=opts.sam
-        
-        if opts.NOonlyMapped:
-            bam, pileup = make_sort_bam_pileup(sam, opts.ref, opts)
-            delete_files(sam)
-        else:
-            mapped_sam = sam_just_mapped(sam)
-            bam, pileup = make_sort_bam_pileup(mapped_sam, opts.ref, opts)
-            num_changes, current_consensus = make_consensus(pileup, opts.ref, opts)    
-            sam_to_bam(sam)
-            delete_files(mapped_sam, sam)
-            
-    elif not opts.pile and opts.bam:
-        bam, pileup = sort_bam_pileup(opts.bam, opts.ref, opts)
-        num_changes, current_consensus = make_consensus(pileup, opts.ref, opts)    
-
-    elif opts.pile:
-        pileup=opts.pileup
-        num_changes, current_consensus = make_consensus(pileup, opts.ref, opts)    
+    #A sam to start from is converted to a bam, and is then handled like a bam from bowtie2 or from -b
+    #The sam is kept with --cacheDir, so that a rerun can find it
+    elif opts.sam and not opts.pile and not opts.bam:
+        bam = cached_stage('sam_to_bam', [opts.sam], [], opts, sam_to_bam, opts.sam)
+        if not opts.cacheDir: delete_files(opts.sam)
+    
+    elif not opts.pile and opts.bam: bam=opts.bam
+    
+    #--streamAlign already made the pileup
+    if bam and not pileup: bam, pileup = sort_bam_pileup(bam, opts.ref, opts, not opts.NOonlyMapped)
+    elif opts.pile: pileup=opts.pile
+    
+    num_changes, current_consensus = make_consensus(pileup, opts.ref, opts)    
         
     #Create final files, leave working directory and clean it
     new_cons_fasta = '%s/%s.fasta' % (opts.startDir, opts.out)
@@ -371,15 +566,18 @@ def create_consensus(opts):
             os.remove(file)
     os.chdir(opts.startDir)
 #    os.rmdir(opts.temp)
+    
+    return num_changes
 
 ###-------------Start of functions to add and remove Ns from reference---------
 
+#The padded reference is written to the current (temp) directory, so that samples running at the same time don't write over each other's copy
 def add_Ns(fasta, num_beg, num_end):
-    new_fasta_name='%s_%dNbeg_%dNend.fasta' % ('.'.join(fasta.split('.')[:-1]), num_beg, num_end)
+    new_fasta_name='%s_%dNbeg_%dNend.fasta' % ('.'.join(fasta.split('/')[-1].split('.')[:-1]), num_beg, num_end)
     names, seqs = read_fasta_lists_simple_names(fasta)
     seqs=[num_beg*'N'+x+num_end*'N' for x in seqs]
     write_fasta(names, seqs, new_fasta_name)
-    return new_fasta_name
+    return os.path.abspath(new_fasta_name)
 
 def trim_Ns(fasta):
     names, seqs = read_fasta_lists_simple_names(fasta)
@@ -391,24 +589,24 @@ def trim_Ns(fasta):
 
 def hard_clip(opts):
     #Clip the specified # bases from the beginning of R1
-    out_name1 = '%s_trim%dbeg' % ('.'.join(opts.paired1.split('/')[-1].split('.')[:-1]), opts.hc)
-    cmd='%s -fastq %s -out_good %s -out_bad null -trim_left %d' % (opts.ps, opts.paired1, out_name1, opts.hc)
-    print cmd
-    ps=Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
-    ps.wait()
-    for line in ps.stderr:
-        print line.rstrip()
+    out_name1 = '%s_trim%dbeg' % (fastq_prefix(opts.paired1.split('/')[-1]), opts.hc)
+    cmd1=prinseq_pipe_cmd('%s -trim_left %d' % (opts.ps, opts.hc), opts.paired1, out_name1, opts)
     
     #Clip the specified # bases from the end of R2
-    out_name2 = '%s_trim%dend' % ('.'.join(opts.paired2.split('/')[-1].split('.')[:-1]), opts.hc)
-    cmd='%s -fastq %s -out_good %s -out_bad null -trim_right %d' % (opts.ps, opts.paired2, out_name2, opts.hc)
-    print cmd
-    ps=Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
-    ps.wait()
-    for line in ps.stderr:
-        print line.rstrip()
+    out_name2 = '%s_trim%dend' % (fastq_prefix(opts.paired2.split('/')[-1]), opts.hc)
+    cmd2=prinseq_pipe_cmd('%s -trim_right %d' % (opts.ps, opts.hc), opts.paired2, out_name2, opts)
+    
+    run_steps(['hard_clip_R1', 'hard_clip_R2'], [cmd1, cmd2], mate_procs(opts))
 
-    return os.path.abspath("%s.fastq" % out_name1), os.path.abspath("%s.fastq" % out_name2)
+    return os.path.abspath(fastq_name(out_name1, opts)), os.path.abspath(fastq_name(out_name2, opts))
+
+#prinseq can only read and write plain fastqs, so gzipped fastqs are piped in and out of it
+def prinseq_pipe_cmd(ps_cmd, fastq, out_name, opts):
+    if not fastq.endswith('.gz') and not opts.gzipFastq: return '%s -fastq %s -out_good %s -out_bad null' % (ps_cmd, fastq, out_name)
+    if fastq.endswith('.gz'): cmd='%s -dc %s | %s -fastq stdin' % (gzip_cmd(), fastq, ps_cmd)
+    else: cmd='%s -fastq %s' % (ps_cmd, fastq)
+    if opts.gzipFastq: return '%s -out_good stdout -out_bad null | %s -c >%s' % (cmd, gzip_cmd(opts.procs), fastq_name(out_name, opts))
+    else: return '%s -out_good %s -out_bad null' % (cmd, out_name)
 
 ###----------Start of Cutadapt and Prinseq functions----------------------------------------
 
@@ -422,18 +620,93 @@ def delete_files(*done_files):
         if os.path.isfile(to_remove):
             os.remove(to_remove)
 
-def run_cutadapt(fastq, ill_adapt, opts):
-    if fastq.endswith('.gz'): out_name = '%s_cutadapt.fastq' % '.'.join(fastq.split('.')[:-2])
-    else: out_name = '%s_cutadapt.fastq' % '.'.join(fastq.split('.')[:-1])
+#Runs cutadapt on R1 and R2 (at the same time with --concurrentMates) and returns the names of the trimmed fastqs
+def run_cutadapt(opts):
+    one_cut, one_info_file, one_cmd = cutadapt_cmd(opts.paired1, opts.i1, opts)
+    two_cut, two_info_file, two_cmd = cutadapt_cmd(opts.paired2, opts.i2, opts)
+    run_steps(['cutadapt_R1', 'cutadapt_R2'], [one_cmd, two_cmd], mate_procs(opts))
+    return one_cut, two_cut
+
+#Returns the names of the output and info files, and the command to run cutadapt
+def cutadapt_cmd(fastq, ill_adapt, opts):
+    #cutadapt writes a gzipped fastq when the output name ends in .gz
+    out_name = fastq_name('%s_cutadapt' % fastq_prefix(fastq), opts)
     info_file_name =  '%s_ca_info.txt' % '.'.join(fastq.split('.')[:-1])
     if opts.sispa: cmd='%s -a illumina=%s %s -o %s -m %d --info-file %s --times 3 --match-read-wildcards %s --trim-n' % (opts.ca, ill_adapt, opts.sispa, out_name, opts.minLength, info_file_name , fastq)
     else: cmd='%s -a illumina=%s -o %s -m %d --info-file %s --times 3 --match-read-wildcards %s --trim-n' % (opts.ca, ill_adapt, out_name, opts.minLength, info_file_name , fastq)
+    return out_name, info_file_name, cmd
+
+#Runs cutadapt on R1 and R2 together. Pairs where either read ends up shorter than --minLength are removed by cutadapt
+#The interleaved output is read straight from cutadapt and the hard clipping is done here, after the adapter trimming like in hard_clip
+def paired_trim(opts):
+    start=time.time()
+    if opts.sispa: sispa_str='%s %s' % (opts.sispa, opts.sispa.replace('-g ', '-G ').replace('-a ', '-A '))
+    else: sispa_str=''
+    cmd='%s --interleaved -a illumina=%s -A illumina=%s %s -m %d --times 3 --match-read-wildcards --trim-n %s %s' % (opts.ca, opts.i1, opts.i2, sispa_str, opts.minLength, opts.paired1, opts.paired2)
     print cmd
-    cutit=Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
+    log=open('cutadapt_paired.log', 'w')
+    cutit=Popen(cmd, shell=True, stdout=PIPE, stderr=log)
+    
+    out_names=[fastq_name('%s_pairtrim' % fastq_prefix(x.split('/')[-1]), opts) for x in [opts.paired1, opts.paired2]]
+    fout1, fout2 = [fastq_open(x, 'w', opts.procs) for x in out_names]
+    for rec in itertools.izip(*[cutit.stdout]*8):
+        name1, seq1, plus1, qual1, name2, seq2, plus2, qual2 = rec
+        if opts.hc:
+            seq1=seq1[opts.hc:]
+            qual1=qual1[opts.hc:]
+            seq2=seq2.rstrip()[:-opts.hc] + '\n'
+            qual2=qual2.rstrip()[:-opts.hc] + '\n'
+            #Skip the pair if a read is now empty
+            if len(seq1)<2 or len(seq2)<2: continue
+        fout1.write(''.join([name1, seq1, plus1, qual1]))
+        fout2.write(''.join([name2, seq2, plus2, qual2]))
     cutit.wait()
-    for line in cutit.stdout:
+    fastq_close(fout1, fout2)
+    log.close()
+    for line in open('cutadapt_paired.log', 'r'):
         print line.rstrip()
-    return out_name, info_file_name
+    log_step_time('cutadapt_paired', start)
+    #Stop this sample if cutadapt failed, instead of mapping whatever part of the output was written
+    if cutit.returncode != 0:
+        delete_files(*out_names)
+        raise Exception('cutadapt exited with status %d, see cutadapt_paired.log' % cutit.returncode)
+    return out_names[0], out_names[1]
+
+###-----Functions for running the read processing steps and keeping track of their times
+
+#Runs each shell command, with up to max_procs of them running at once
+#The output (stdout and stderr) of each command goes to a <name>.log file, so that a chatty program can't fill up a pipe and hang. The log is printed when the step is done
+def run_steps(names, cmds, max_procs=1):
+    waiting=zip(names, cmds)
+    running=[]
+    while waiting or running:
+        while waiting and len(running)<max_procs:
+            name, cmd = waiting.pop(0)
+            print cmd
+            log=open('%s.log' % name, 'w')
+            running.append([name, Popen(cmd, shell=True, stdout=log, stderr=STDOUT), log, time.time()])
+        for each in running[:]:
+            name, proc, log, start = each
+            if proc.poll() is None: continue
+            log.close()
+            for line in open('%s.log' % name, 'r'):
+                print line.rstrip()
+            log_step_time(name, start)
+            running.remove(each)
+        if running: time.sleep(0.5)
+
+#Number of per-mate steps to run at once
+def mate_procs(opts):
+    if opts.concurrentMates: return min(2, max(1, opts.procs))
+    else: return 1
+
+#Prints the wall time of a step and adds it to step_times.txt in the current directory
+def log_step_time(name, start):
+    minutes=(time.time()-start)/60
+    print '%s took %.2f minutes' % (name, minutes)
+    fout=open('step_times.txt', 'a')
+    fout.write('%s\t%.2f\n' % (name, minutes))
+    fout.close()
 
 ###-----Functions for removing random primers after running cutadapt with the sispa seqs
 
@@ -441,8 +714,8 @@ def trim_fastq(fq, ifile, opts):
 
     info_dict=make_info_dict(ifile)
     
-    fin=open(fq, 'r')
-    fout=open('%s_trimmed' % fq, 'w')
+    fin=fastq_open(fq)
+    fout=fastq_open('%s_trimmed' % fq, 'w', opts.procs)
     
     while 1:
         this_read = []
@@ -450,8 +723,7 @@ def trim_fastq(fq, ifile, opts):
             this_read.append(fin.readline())
         if this_read[0]=='': 
             #Close all open files
-            fout.close()
-            fin.close()
+            fastq_close(fout, fin)
             return '%s_trimmed' % fq
         else:
             name=this_read[0].strip()[1:]
@@ -479,70 +751,162 @@ def make_info_dict(info_file):
 ###-------------------------------------------------------
 
 def paired_prinseq(opts):
-    out_name = '%s_good' % '.'.join(opts.paired1.split('/')[-1].split('.')[:-1])
-    cmd='%s -fastq %s -fastq2 %s -out_good %s -out_bad null -min_len %d -lc_method dust -lc_threshold 3 -derep 14 -trim_qual_right %d -trim_qual_type %s -trim_qual_window %d -min_qual_mean %d' % (opts.ps, opts.paired1, opts.paired2, out_name, opts.minLength, opts.trimQual, opts.trimType, opts.trimWin, opts.meanQual)
-    print cmd
-    ps=Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
-    ps.wait()
-    for line in ps.stderr:
-        print line.rstrip()
+    out_name = '%s_good' % fastq_prefix(opts.paired1.split('/')[-1])
+    #prinseq can't read gzipped pairs, so these are unzipped into temporary files
+    fastq1, fastq2 = [gunzip_fastq(x, '%s_ps%d.fastq' % (out_name, i+1)) for i, x in enumerate([opts.paired1, opts.paired2])]
+    cmd='%s -fastq %s -fastq2 %s -out_good %s -out_bad null -min_len %d -lc_method dust -lc_threshold 3 -derep 14 -trim_qual_right %d -trim_qual_type %s -trim_qual_window %d -min_qual_mean %d' % (opts.ps, fastq1, fastq2, out_name, opts.minLength, opts.trimQual, opts.trimType, opts.trimWin, opts.meanQual)
+    run_steps(['prinseq'], [cmd])
     
     #Deleting singleton files because they are not being used
     delete_files('%s_1_singletons.fastq' % out_name, '%s_2_singletons.fastq' % out_name)
+    if fastq1 != opts.paired1: delete_files(fastq1, fastq2)
     
+    if opts.gzipFastq: return gzip_fastq('%s_1.fastq' % out_name, opts), gzip_fastq('%s_2.fastq' % out_name, opts)
     return '%s_1.fastq' % out_name, '%s_2.fastq' % out_name
     
 #For sifting through fastqs and just keeping what is still paired
-
-def paired_sort(read1, read2):
-    names1 = get_names(read1)
-    names2 = get_names(read2)
-    paired = set(names1) & set(names2)
-
+#Cutadapt keeps the reads in their original order, so R1 and R2 are read side by side and only the reads that have not found their mate yet are held in memory
+#The next read is taken from the file with fewer reads waiting, so a file that lost more reads than the other doesn't fall behind
+#Reads that lost their mate are dropped. The names of the last max_pending of them from each file are kept to check that the two files really are in the same order
+#If a read's mate was already dropped, or more than max_pending reads are waiting for a mate, this starts over and joins the reads by name
+def paired_sort(read1, read2, opts, max_pending=100000):
+    fastqs=[read1, read2]
+    pair_names=[fastq_name(fastq_prefix(x) + '_paired', opts) for x in fastqs]
+    pair_outs=[fastq_open(x, 'w', opts.procs) for x in pair_names]
+    reads=[fastq_records(x) for x in fastqs]
+    pending=[collections.OrderedDict(), collections.OrderedDict()]
+    singles=[collections.OrderedDict(), collections.OrderedDict()]
+    done=[False, False]
+    in_order=True
+    
+    #The readers (and any gunzip processes) are closed even when this stops early
+    try:
+        while in_order and not all(done):
+            if done[0]: i=1
+            elif done[1]: i=0
+            elif len(pending[0])<=len(pending[1]): i=0
+            else: i=1
+            rec=next(reads[i], None)
+            if rec is None:
+                done[i]=True
+                continue
+            name=rec[0].split()[0]
+            j=1-i
+            if name in pending[j]:
+                #Anything that came before the mate in the other file, or before this read in this file, can't be paired anymore
+                while True:
+                    other_name, other = pending[j].popitem(last=False)
+                    if other_name == name: break
+                    add_single(singles[j], other_name, max_pending)
+                for each_name in pending[i]: add_single(singles[i], each_name, max_pending)
+                pending[i].clear()
+                pair_outs[i].write(''.join(rec))
+                pair_outs[j].write(''.join(other))
+            else:
+                pending[i][name]=rec
+                if name in singles[j] or len(pending[i])>max_pending: in_order=False
+    finally:
+        for each in reads: each.close()
+        fastq_close(*pair_outs)
+    
+    if not in_order:
+        print '%s and %s are not in the same order, re-pairing by read name' % (read1, read2)
+        return paired_sort_by_name(read1, read2, opts)
+    return pair_names[0], pair_names[1]
+
+#Adds a name to the OrderedDict of recent singles, dropping the oldest name once there are more than max_names
+def add_single(singles, name, max_names):
+    singles[name]=True
+    if len(singles)>max_names: singles.popitem(last=False)
+
+#Used by paired_sort when the reads are not in the same order in the two files
+#Only the names from read1, and the names that are found in both files, are held in memory
+def paired_sort_by_name(read1, read2, opts):
+    names1=set([rec[0].split()[0] for rec in fastq_records(read1)])
+    paired=set()
+    
+    pair2_file=fastq_name(fastq_prefix(read2) + '_paired', opts)
+    fout_pair=fastq_open(pair2_file, 'w', opts.procs)
+    for rec in fastq_records(read2):
+        name=rec[0].split()[0]
+        if name in names1:
+            paired.add(name)
+            fout_pair.write(''.join(rec))
+    fastq_close(fout_pair)
     del names1
-    del names2
-
-    pair1_file = write_new_file(read1, paired)
-    pair2_file = write_new_file(read2, paired)
+    
+    pair1_file=fastq_name(fastq_prefix(read1) + '_paired', opts)
+    fout_pair=fastq_open(pair1_file, 'w', opts.procs)
+    for rec in fastq_records(read1):
+        if rec[0].split()[0] in paired: fout_pair.write(''.join(rec))
+    fastq_close(fout_pair)
     
     return pair1_file, pair2_file
 
-def get_names(file):
-    fin = open(file, 'r')	
-    names=[]
-    linenum=0
-
-    for line in fin:
-        linenum+=1
-        #First name line
-        if linenum%4==1:
-            names.append(line.strip().split()[0])
-    fin.close()
-    return names
-
-def write_new_file(fastq, paired_names):
-
-    fin = open(fastq, 'r')
-    fout_pair = open('.'.join(fastq.split('.')[:-1]) + '_paired.fastq', 'w')
-    linenum=0
-    is_paired=0
+#Yields each fastq record as a tuple of its four lines
+#The file is closed when the generator is closed, even if it wasn't read to the end
+def fastq_records(file):
+    fin = fastq_open(file)
+    try:
+        for rec in itertools.izip(fin, fin, fin, fin): yield rec
+    finally: fastq_close(fin)
+
+###-----Functions for reading and writing fastqs that may be gzipped
+
+#Compression program to use. pigz (multi-threaded) or igzip (isa-l) are used if they are in $PATH
+def gzip_cmd(procs=1):
+    if find_executable('pigz'): return 'pigz -p %d' % procs
+    elif find_executable('igzip'): return 'igzip -T %d' % procs
+    else: return 'gzip'
+
+#Name for a new fastq. Ends in .gz with --gzipFastq
+def fastq_name(prefix, opts):
+    if opts.gzipFastq: return '%s.fastq.gz' % prefix
+    else: return '%s.fastq' % prefix
+
+#Fastq name without the .fastq (or .fq, etc.) and .gz extensions
+def fastq_prefix(fastq):
+    if fastq.endswith('.gz'): fastq=fastq[:-3]
+    return '.'.join(fastq.split('.')[:-1])
+
+#Holds the (de)compression process for each open gzipped fastq, so that fastq_close can wait for it to finish
+gzip_procs={}
+
+#Opens a fastq for reading ('r') or writing ('w'). Files ending in .gz are (de)compressed through a pipe
+def fastq_open(fastq, mode='r', procs=1):
+    if not fastq.endswith('.gz'): return open(fastq, mode)
+    if mode == 'r':
+        #With the default SIGPIPE handling, the decompression just stops quietly if the file is closed before it has all been read
+        proc=Popen('%s -dc %s' % (gzip_cmd(), fastq), shell=True, stdout=PIPE, preexec_fn=lambda: signal.signal(signal.SIGPIPE, signal.SIG_DFL))
+        handle=proc.stdout
+    else:
+        proc=Popen('%s -c >%s' % (gzip_cmd(procs), fastq), shell=True, stdin=PIPE)
+        handle=proc.stdin
+    gzip_procs[handle]=proc
+    return handle
+
+def fastq_close(*handles):
+    for handle in handles:
+        handle.close()
+        if handle in gzip_procs: gzip_procs.pop(handle).wait()
+
+#Returns the name of an unzipped copy of the fastq (new_name), or the same name if it isn't gzipped
+def gunzip_fastq(fastq, new_name):
+    if not fastq.endswith('.gz'): return fastq
+    cmd='%s -dc %s >%s' % (gzip_cmd(), fastq, new_name)
+    print cmd
+    unzip=Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
+    unzip.wait()
+    return new_name
 
-    for line in fin:
-        linenum+=1
-        #First name line
-        if linenum%4==1:
-            name=line.strip().split()[0]
-            if name in paired_names:
-                is_paired=1
-                fout_pair.write(line)	
-            else:
-                is_paired=0
-        #Other lines
-        else:
-            if is_paired: fout_pair.write(line)
-    fin.close()
-    fout_pair.close()
-    return '.'.join(fastq.split('.')[:-1]) + '_paired.fastq'
+#Replaces a plain fastq with a gzipped one
+def gzip_fastq(fastq, opts):
+    cmd='%s -c %s >%s.gz' % (gzip_cmd(opts.procs), fastq, fastq)
+    print cmd
+    zipit=Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
+    zipit.wait()
+    delete_files(fastq)
+    return '%s.gz' % fastq
 
 
 ###----------Start of samtools functions----------------------------------------
@@ -553,169 +917,495 @@ def sam_to_bam(sam):
     cmd='samtools view -bS %s >%s' % (sam, bam_name)
     print cmd
     make_bam=Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
-    make_bam.wait()
-    
+    err=make_bam.communicate()[1]
+    if make_bam.returncode != 0: raise Exception('samtools view failed for %s (exit status %d):\n%s' % (sam, make_bam.returncode, err))
+    return bam_name
+
+def index_bam(bam):
+    cmd='samtools index %s' % bam
+    print cmd
+    make_index=Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
+    make_index.wait()
 
-def make_sort_bam_pileup(sam, ref, opts):
+#Skipped if the reference already has a .fai that is at least as new as the reference
+def make_faidx(ref):
+    fai='%s.fai' % ref
+    if os.path.isfile(fai) and os.path.getmtime(fai) >= os.path.getmtime(ref): return
     #Make new faidx for current reference
     cmd='samtools faidx %s' % ref
     print cmd
     faidx=Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
     faidx.wait()
+
+#With only_mapped=True, unmapped reads are dropped (samtools view -F 4) as the bam is piped into samtools sort, so the output names are the same as without the filter
+def sort_bam_pileup(bam, ref, opts, only_mapped=False):
+    make_faidx(ref)
     
-    #Make bam from sam, and sort the bam
-    sam_prefix='.'.join(sam.split('/')[-1].split('.')[:-1])
+    #Sort the bam
+    bam_prefix='.'.join(bam.split('/')[-1].split('.')[:-1])
+    if only_mapped: cmd='samtools view -u -F 4 %s | %s' % (bam, samtools_sort_cmd('-', bam_prefix + '_sorted'))
+    else: cmd=samtools_sort_cmd(bam, bam_prefix + '_sorted')
+    bam_name=cached_stage('sort', [bam], [only_mapped], opts, run_cmd, cmd, '%s_sorted.bam' % bam_prefix)
+    
+    return dedup_pileup(bam_name, bam_prefix, ref, opts)
+
+#Streaming version of bowtie2_index_align + sort_bam_pileup
+#bowtie2 output is piped straight into samtools sort, so there is no separate pass to sort the bam
+#Unless --NOonlyMapped is used, only mapped reads go to the sorted bam. All of the reads are still saved in an unsorted bam (same name as from bowtie2_index_align)
+def stream_align_sort_pileup(ref, opts):
+    make_faidx(ref)
+    
+    sam_prefix='%s_aligned' % opts.out
+    if not opts.NOonlyMapped: sam_prefix='%s_onlymapped' % sam_prefix
+    bams=cached_stage('stream_align', [ref, opts.unpaired, opts.paired1, opts.paired2], [opts.nceil, opts.minIns, opts.maxIns, opts.NOonlyMapped], opts, stream_align_sort, ref, sam_prefix, opts)
+    
+    return dedup_pileup(bams[0], sam_prefix, ref, opts)
+
+#Returns the names of the sorted bam, and of the bam with all of the reads unless --NOonlyMapped is used
+#Unless --NOonlyMapped is used, the full bam is written by tee, and the unmapped reads are dropped by samtools (-F 4) on the way to samtools sort
+def stream_align_sort(ref, sam_prefix, opts):
+    index=bowtie2_build(ref, opts)
+    
+    align_cmd=bowtie2_cmd('-', index, opts)
+    if not align_cmd: raise Exception('No reads to align with bowtie2')
+    #bowtie2 messages go to a log file, so that they can't fill up a pipe and block bowtie2
+    align_cmd='%s 2>%s_bowtie2.log' % (align_cmd, opts.out)
     bam_name='%s_sorted.bam' % sam_prefix
-    cmd='samtools view -bS %s | samtools sort -m 800000000 - %s' % (sam, sam_prefix + '_sorted')
-    print cmd
-    make_bam=Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
-    make_bam.wait()
+    sort_cmd=samtools_sort_cmd('-', sam_prefix + '_sorted')
+    
+    if opts.NOonlyMapped:
+        run_pipeline([align_cmd, 'samtools view -uS -', sort_cmd])
+        return [bam_name]
     
-#***NEW in _picard version ***    
-    #Make a new version of the bam with duplicates removed using the MarkDuplicates function in picard
+    run_pipeline([align_cmd, 'samtools view -bS -', 'tee %s_aligned.bam' % opts.out, 'samtools view -u -F 4 -', sort_cmd])
+    return [bam_name, '%s_aligned.bam' % opts.out]
+
+#Runs the shell commands with the output of each one piped into the next (cmd1 | cmd2 | ...)
+#Unlike a shell pipeline, the exit status of every command is checked, and an exception is raised if any of them failed
+def run_pipeline(cmds):
+    print ' | '.join(cmds)
+    procs=[]
+    for index, cmd in enumerate(cmds):
+        if procs: stdin=procs[-1].stdout
+        else: stdin=None
+        if index < len(cmds)-1: stdout=PIPE
+        else: stdout=None
+        procs.append(Popen(cmd, shell=True, stdin=stdin, stdout=stdout, preexec_fn=lambda: signal.signal(signal.SIGPIPE, signal.SIG_DFL)))
+        #Only the next command should hold the read end of the pipe, so that the earlier command stops if the next one does
+        if stdin: stdin.close()
+    for proc in procs: proc.wait()
+    failed=['%s (exit status %d)' % (cmd, proc.returncode) for cmd, proc in zip(cmds, procs) if proc.returncode != 0]
+    if failed: raise Exception('Failed: %s' % ', '.join(failed))
+
+#Removes duplicates (unless --NOpicard) and makes the pileup from a sorted bam. Returns the final bam and pileup names
+def dedup_pileup(bam_name, prefix, ref, opts):
+    #Make a new version of the bam with duplicates removed
     if not opts.NOpicard:
-        dup_bam_name='%s_sorted_nodups.bam' % sam_prefix
-        dup_cmd="java -XX:ParallelGCThreads=%s -jar %s MarkDuplicates REMOVE_DUPLICATES=true ASSUME_SORTED=true O=%s M=%s_metrics.txt I=%s" % (opts.procs, opts.pc, dup_bam_name, dup_bam_name, bam_name)
-        print dup_cmd
-        rmdups=Popen(dup_cmd, shell=True, stdout=PIPE, stderr=PIPE)
-        rmdups.wait()
-        bam_name=dup_bam_name
-
+        dup_bam_name='%s_sorted_nodups.bam' % prefix
+        bam_name=cached_stage('dedup', [bam_name], [opts.dedup, opts.pc], opts, remove_dups, bam_name, dup_bam_name, opts)
+    
+    #With --pysamPile, no pileup file is made. make_consensus walks the bam directly, so it just needs to be indexed
+    if opts.pysamPile:
+        restore_cached(bam_name)
+        index_bam(bam_name)
+        return bam_name, bam_name
     
     #Make pileup from bam
     #I added the -B to prevent the altering of the quality values
-    pile_name='%s.pile' % sam_prefix
+    pile_name='%s.pile' % prefix
     if opts.useAnomPairs: cmd='samtools mpileup -f %s -q %d -d %d  -BA %s >%s' % (ref, opts.mapQ, opts.maxCov, bam_name, pile_name)
     else: cmd='samtools mpileup -f %s -q %d -d %d  -B %s >%s' % (ref, opts.mapQ, opts.maxCov, bam_name, pile_name)
-    print cmd
-    make_pileup=Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
-    make_pileup.wait()
+    pile_name=cached_stage('pileup', [bam_name, ref], [opts.mapQ, opts.maxCov, opts.useAnomPairs], opts, run_cmd, cmd, pile_name)
+    restore_cached(pile_name)
     
     return bam_name, pile_name
-#***End of NEW ***
-
 
-def sort_bam_pileup(bam, ref, opts):
-    #Make new faidx for current reference
-    cmd='samtools faidx %s' % ref
-    print cmd
-    faidx=Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
-    faidx.wait()
+#Makes dup_bam_name, with the duplicates in bam_name removed, and dup_bam_name + _metrics.txt, using the method chosen with --dedup
+def remove_dups(bam_name, dup_bam_name, opts):
+    metrics_name='%s_metrics.txt' % dup_bam_name
     
-    #Sort the bam
-    bam_prefix='.'.join(bam.split('/')[-1].split('.')[:-1])
-    bam_name='%s_sorted.bam' % bam_prefix
-    cmd='samtools sort -m 800000000 %s %s' % (bam, bam_prefix + '_sorted')
-    print cmd
-    make_bam=Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
-    make_bam.wait()
+    #Using the MarkDuplicates function in picard
+    if opts.dedup == 'picard':
+        dup_cmd="java -XX:ParallelGCThreads=%s -jar %s MarkDuplicates REMOVE_DUPLICATES=true ASSUME_SORTED=true O=%s M=%s I=%s" % (opts.procs, opts.pc, dup_bam_name, metrics_name, bam_name)
+        return run_cmd(dup_cmd, dup_bam_name)
     
-#***NEW in _picard version ***    
-    #Make a new version of the bam with duplicates removed using the MarkDuplicates function in picard
-    if not opts.NOpicard:
-        dup_bam_name='%s_sorted_nodups.bam' % bam_prefix
-        dup_cmd="java -XX:ParallelGCThreads=%s -jar %s MarkDuplicates REMOVE_DUPLICATES=true ASSUME_SORTED=true O=%s M=%s_metrics.txt I=%s" % (opts.procs, opts.pc, dup_bam_name, dup_bam_name, bam_name)
+    #markdup needs the mate tags added by fixmate -m, which needs a name sorted bam
+    elif opts.dedup == 'markdup':
+        prefix=dup_bam_name[:-4]
+        dup_cmd='%s && samtools fixmate -m %s_byname.bam %s_fixmate.bam && %s && samtools markdup -r -s %s_fixmate_sorted.bam %s' % (samtools_sort_cmd(bam_name, '%s_byname' % prefix, '-n'), prefix, prefix, samtools_sort_cmd('%s_fixmate.bam' % prefix, '%s_fixmate_sorted' % prefix), prefix, dup_bam_name)
         print dup_cmd
-        rmdups=Popen(dup_cmd, shell=True, stdout=PIPE, stderr=PIPE)
-        rmdups.wait()
-        bam_name = dup_bam_name
-
-#*** Also needed to change the bam being used in the pileup formation
+        markdup=Popen(dup_cmd, shell=True, stdout=PIPE, stderr=PIPE)
+        out, err = markdup.communicate()
+        delete_files('%s_byname.bam' % prefix, '%s_fixmate.bam' % prefix, '%s_fixmate_sorted.bam' % prefix)
+        if markdup.returncode != 0:
+            delete_files(dup_bam_name)
+            raise Exception('Removing duplicates with samtools markdup failed:\n%s' % err)
+        
+        #Converts the markdup stats (which are for reads) to picard's columns (which are for pairs)
+        stats={}
+        for line in err.split('\n'):
+            if ': ' in line:
+                key, value = line.split(': ', 1)
+                if value.strip().isdigit(): stats[key]=int(value)
+        counts=dup_counts()
+        counts['UNPAIRED_READS_EXAMINED']=stats.get('SINGLE', 0)
+        counts['READ_PAIRS_EXAMINED']=stats.get('PAIRED', 0)//2
+        counts['UNPAIRED_READ_DUPLICATES']=stats.get('DUPLICATE SINGLE', 0)
+        counts['READ_PAIR_DUPLICATES']=stats.get('DUPLICATE PAIR', 0)//2
+        counts['READ_PAIR_OPTICAL_DUPLICATES']=stats.get('DUPLICATE PAIR OPTICAL', 0)//2
+        write_dup_metrics(metrics_name, dup_cmd, counts)
+        return dup_bam_name
     
-    #Make pileup from bam
-    pile_name='%s.pile' % bam_prefix
-    if opts.useAnomPairs: cmd='samtools mpileup -f %s -q %d -d %d -BA %s >%s' % (ref, opts.mapQ, opts.maxCov, bam_name, pile_name)
-    else: cmd='samtools mpileup -f %s -q %d -d %d  -B %s >%s' % (ref, opts.mapQ, opts.maxCov, bam_name, pile_name)
-    print cmd
-    make_pileup=Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
-    make_pileup.wait()
+    else:
+        print 'Removing duplicates from %s with pysam' % bam_name
+        write_dup_metrics(metrics_name, 'pysam_dedup %s %s' % (bam_name, dup_bam_name), pysam_dedup(bam_name, dup_bam_name))
+        return dup_bam_name
+
+#Columns of picard's DuplicationMetrics, other than LIBRARY, PERCENT_DUPLICATION and ESTIMATED_LIBRARY_SIZE
+def dup_counts():
+    return collections.OrderedDict([(x, 0) for x in ['UNPAIRED_READS_EXAMINED', 'READ_PAIRS_EXAMINED', 'SECONDARY_OR_SUPPLEMENTARY_RDS', 'UNMAPPED_READS', 'UNPAIRED_READ_DUPLICATES', 'READ_PAIR_DUPLICATES', 'READ_PAIR_OPTICAL_DUPLICATES']])
+
+#Removes duplicates from a coordinate sorted bam with pysam, with rules like picard MarkDuplicates (REMOVE_DUPLICATES=true), and returns the counts for the metrics file
+#Pairs are duplicates if both reads have the same unclipped 5' positions and strands, with the ends ordered by position like picard (read 1 first if they are at the same position). The pair with the highest sum of base qualities (>=15) is kept
+#Unpaired reads (and reads with an unmapped mate) are duplicates if a paired read has the same 5' position and strand, or if an unpaired read with a higher score does
+#The bam is read once. Each read is held until it is known whether it is a duplicate, which is once the bam is more than window bp past the 5' ends of its group, so the reads held depend on the insert sizes rather than on the size of the bam
+#window needs to be more than the distance between a read's start and its unclipped 5' end (read length + clipping for reverse reads)
+#The first read of a pair whose mate is on another reference, or starts more than window bp later, is written to a separate bam instead of being held. The two bams are merged at the end, leaving out the pairs that were duplicates
+#Every read is treated as being from the same library, and optical duplicates are not looked for
+def pysam_dedup(bam_name, dup_bam_name, window=1000):
+    #Only imported here so that pysam is not needed unless --dedup pysam is used
+    import pysam
+    counts=dup_counts()
+    #[read, keep] for each read, in the order of the bam. keep is None until it is known
+    held=collections.deque()
+    first_mates={}
+    pair_groups={}
+    frag_groups={}
+    paired_ends=set()
+    #Heaps of the mate starts of first_mates, and of the 5' ends of the groups, so that the ones that can be finished are found without going through all of them
+    mate_starts=[]
+    group_ends=[]
+    #Names of the pairs with a read in the far mates bam that were duplicates
+    far_dups=set()
+    num_far=0
+    last_check=None
     
-    return bam_name, pile_name
-#***End of NEW ***
-
-
-#This function doesn't actually call samtools, but its related
-#Creates a new samfile containing only the header and the information for reads that actually mapped to the referene.
-#Uses bit 4 of the flag to check if the read is mapped. 
-def sam_just_mapped(samfile):
-    sam = open(samfile, 'r')
-    new_name='%s_onlymapped.sam' % '.'.join(samfile.split('.')[:-1])
-    new = open(new_name, 'w')
-    for line in sam:
-        if line[0] != '@':
-            cols=line.split()
-            if not int(cols[1]) & 0x4:new.write(line) 
-        else: new.write(line)
-    sam.close()
-    new.close()
-    return new_name
+    bam=pysam.AlignmentFile(bam_name, 'rb')
+    near_name='%s.near.tmp' % dup_bam_name
+    far_name='%s.far.tmp' % dup_bam_name
+    out=pysam.AlignmentFile(near_name, 'wb', template=bam)
+    far_out=pysam.AlignmentFile(far_name, 'wb', template=bam)
+    for read in bam.fetch(until_eof=True):
+        entry=[read, True]
+        if read.is_unmapped: counts['UNMAPPED_READS']+=1
+        elif read.is_secondary or read.is_supplementary: counts['SECONDARY_OR_SUPPLEMENTARY_RDS']+=1
+        else:
+            entry[1]=None
+            end=five_prime_end(read)
+            if read.query_qualities: score=sum([x for x in read.query_qualities if x>=15])
+            else: score=0
+            
+            if read.is_paired and not read.mate_is_unmapped:
+                if end not in paired_ends:
+                    paired_ends.add(end)
+                    heapq.heappush(group_ends, (end[:2], 2, end))
+                if read.query_name not in first_mates:
+                    if read.next_reference_id != read.reference_id or read.next_reference_start-read.reference_start > window:
+                        far_out.write(read)
+                        num_far+=1
+                        #Only the name is kept, to look up the pair in far_dups at the end
+                        entry=[None, None, read.query_name]
+                    first_mates[read.query_name]=[entry, end, score, read.is_read1]
+                    heapq.heappush(mate_starts, ((read.next_reference_id, read.next_reference_start), read.query_name))
+                else:
+                    first_entry, first_end, first_score, first_is_read1 = first_mates.pop(read.query_name)
+                    counts['READ_PAIRS_EXAMINED']+=1
+                    key=pair_key(first_end, first_is_read1, end)
+                    if key not in pair_groups:
+                        pair_groups[key]=[]
+                        heapq.heappush(group_ends, (key[1][:2], 0, key))
+                    pair_groups[key].append([score+first_score, first_entry, entry])
+            else:
+                counts['UNPAIRED_READS_EXAMINED']+=1
+                if end not in frag_groups:
+                    frag_groups[end]=[]
+                    heapq.heappush(group_ends, (end[:2], 1, end))
+                frag_groups[end].append([score, entry])
+        if entry[0] is not None: held.append(entry)
+        
+        #Unplaced reads are at the end of a sorted bam, so everything before them can be finished
+        if read.reference_id < 0: position=None
+        else: position=(read.reference_id, read.reference_start)
+        if position is None or last_check is None or position[0] != last_check[0] or position[1]-last_check[1] >= window//10:
+            finish_dup_groups(position, window, first_mates, mate_starts, pair_groups, frag_groups, paired_ends, group_ends, far_dups, counts)
+            last_check=position
+            while held and held[0][1] is not None:
+                each, keep = held.popleft()
+                if keep: out.write(each)
+    
+    finish_dup_groups(None, window, first_mates, mate_starts, pair_groups, frag_groups, paired_ends, group_ends, far_dups, counts)
+    for each, keep in held:
+        if keep: out.write(each)
+    for each in [out, far_out, bam]: each.close()
+    
+    if num_far: merge_sorted_bams(near_name, far_name, dup_bam_name, far_dups)
+    else: os.rename(near_name, dup_bam_name)
+    delete_files(near_name, far_name)
+    
+    return counts
+
+#Key for the 5' ends of a pair, with the lower end first. If both ends are at the same position, the end of read 1 is first
+def pair_key(first_end, first_is_read1, second_end):
+    if first_end[:2] < second_end[:2] or (first_end[:2] == second_end[:2] and first_is_read1): return (first_end, second_end)
+    else: return (second_end, first_end)
+
+#Decides which reads are duplicates for the groups whose reads have all been read, because position (reference id, start) is more than window bp past their 5' ends
+#position=None is for the end of the bam, when every group is finished
+def finish_dup_groups(position, window, first_mates, mate_starts, pair_groups, frag_groups, paired_ends, group_ends, far_dups, counts):
+    #Reads whose mate starts before position, but was never read (e.g., the bam was filtered), are kept
+    while mate_starts and (position is None or mate_starts[0][0] < position):
+        mate_start, name = heapq.heappop(mate_starts)
+        if name in first_mates: first_mates.pop(name)[0][1]=True
+    
+    #For each position, the pairs are finished first, then the unpaired reads (which need paired_ends), and then the paired ends are dropped
+    while group_ends:
+        end_pos, kind, key = group_ends[0]
+        if position is not None and end_pos >= (position[0], position[1]-window): break
+        heapq.heappop(group_ends)
+        if kind == 0:
+            pairs=pair_groups.pop(key)
+            #Keeps the first pair with the highest score
+            best=max(pairs, key=lambda x: x[0])
+            for each in pairs:
+                each[1][1]=each is best
+                each[2][1]=each is best
+                if each is not best and each[1][0] is None: far_dups.add(each[1][2])
+            counts['READ_PAIR_DUPLICATES']+=len(pairs)-1
+        elif kind == 1:
+            frags=frag_groups.pop(key)
+            if key in paired_ends: best=None
+            #Keeps the first read with the highest score
+            else: best=max(frags, key=lambda x: x[0])
+            for each in frags:
+                each[1][1]=each is best
+                if each is not best: counts['UNPAIRED_READ_DUPLICATES']+=1
+        else: paired_ends.remove(key)
+
+#Writes the reads of two coordinate sorted bams to out_name, in coordinate order, leaving out the reads of far_name whose names are in skip_names
+def merge_sorted_bams(near_name, far_name, out_name, skip_names):
+    import pysam
+    near=pysam.AlignmentFile(near_name, 'rb')
+    far=pysam.AlignmentFile(far_name, 'rb')
+    out=pysam.AlignmentFile(out_name, 'wb', template=near)
+    #Unplaced reads (reference id -1) go at the end
+    sort_key=lambda read: (read.reference_id < 0, read.reference_id, read.reference_start)
+    near_reads=((sort_key(x), 0, x) for x in near.fetch(until_eof=True))
+    far_reads=((sort_key(x), 1, x) for x in far.fetch(until_eof=True) if x.query_name not in skip_names)
+    for key, source, read in heapq.merge(near_reads, far_reads): out.write(read)
+    for each in [out, near, far]: each.close()
+
+#Reference, unclipped 5' position and strand of a read, like picard uses to find duplicates
+def five_prime_end(read):
+    clip_ops=[4, 5]
+    cigar=read.cigartuples
+    if read.is_reverse:
+        clipped=0
+        for op, length in reversed(cigar):
+            if op not in clip_ops: break
+            clipped+=length
+        return (read.reference_id, read.reference_end-1+clipped, True)
+    else:
+        clipped=0
+        for op, length in cigar:
+            if op not in clip_ops: break
+            clipped+=length
+        return (read.reference_id, read.reference_start-clipped, False)
+
+#Writes counts (from dup_counts) as a picard DuplicationMetrics file, so reports that read the picard metrics still work
+def write_dup_metrics(metrics_name, cmd, counts):
+    examined=counts['UNPAIRED_READS_EXAMINED'] + 2*counts['READ_PAIRS_EXAMINED']
+    if examined: percent=(counts['UNPAIRED_READ_DUPLICATES'] + 2*counts['READ_PAIR_DUPLICATES'])/examined
+    else: percent=0
+    pairs=counts['READ_PAIRS_EXAMINED'] - counts['READ_PAIR_OPTICAL_DUPLICATES']
+    library_size=estimate_library_size(pairs, counts['READ_PAIRS_EXAMINED'] - counts['READ_PAIR_DUPLICATES'])
     
+    fout=open(metrics_name, 'w')
+    fout.write('## htsjdk.samtools.metrics.StringHeader\n# %s\n## htsjdk.samtools.metrics.StringHeader\n# Started on: %s\n\n' % (cmd, time.ctime()))
+    fout.write('## METRICS CLASS\tpicard.sam.DuplicationMetrics\n')
+    fout.write('LIBRARY\t%s\tPERCENT_DUPLICATION\tESTIMATED_LIBRARY_SIZE\n' % '\t'.join(counts.keys()))
+    fout.write('Unknown Library\t%s\t%.6f\t%s\n\n' % ('\t'.join([str(x) for x in counts.values()]), percent, library_size))
+    fout.close()
+
+#Same Lander-Waterman estimate as picard. Returns '' (blank in the metrics file, like picard) if it can't be estimated
+def estimate_library_size(pairs, unique_pairs):
+    if not pairs or not unique_pairs or unique_pairs >= pairs: return ''
+    f=lambda x: unique_pairs/x - 1 + np.exp(-pairs/x)
+    low=1.0
+    high=100.0
+    if f(low*unique_pairs) < 0: return ''
+    while f(high*unique_pairs) > 0: high*=10.0
+    for i in range(40):
+        r=(low+high)/2.0
+        u=f(r*unique_pairs)
+        if u == 0: break
+        elif u > 0: low=r
+        else: high=r
+    return int(unique_pairs*(low+high)/2.0)
+
+#Returns the version of the samtools in $PATH as a tuple of ints (e.g., (1, 9)), or () if it can't be found
+#Running samtools without a command prints the usage, which starts with the version in all versions of samtools
+def samtools_version():
+    usage=Popen('samtools', shell=True, stdout=PIPE, stderr=PIPE)
+    out, err = usage.communicate()
+    match=re.search(r'Version: ([0-9.]+)', out+err)
+    if match: return tuple([int(x) for x in match.group(1).strip('.').split('.') if x])
+    else: return ()
+
+#samtools sort command that sorts in_name ('-' for stdin) into prefix.bam
+#samtools >=1.3 only takes the output name with -o (and the temporary file prefix with -T), older versions only take the output prefix as the last argument
+#If the version can't be found, the newer form is used
+def samtools_sort_cmd(in_name, prefix, flags=''):
+    version=samtools_version()
+    if version and version < (1, 3): cmd='samtools sort %s -m 800000000 %s %s' % (flags, in_name, prefix)
+    else: cmd='samtools sort %s -m 800000000 -T %s -o %s.bam %s' % (flags, prefix, prefix, in_name)
+    return ' '.join(cmd.split())
+
+#Runs a shell command and returns the name of the file that it makes
+def run_cmd(cmd, out_name):
+    print cmd
+    run=Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
+    run.wait()
+    return out_name
+
+
 ###----------End of samtools functions----------------------------------------		
 
 ###-----------Start of functions used in making consensus from pileup-----------
 
-#Doesn't actually return anything, just changes zero coverage bases to Ns
-def zero_to_Ns(ref_dict, pileup):
-    #Make dict of bases in pileup
-    pile_dict={}
-    fin=open(pileup, 'r')
-    for line in fin:
-        cols=line.strip().split('\t')
-        if cols[0] not in pile_dict: pile_dict[cols[0]]=[]
-        pile_dict[cols[0]].append(int(cols[1]))
-    fin.close()
-
-    #Find missing bases and replace them with Ns
-    for chrom, base_list in ref_dict.iteritems():
-        if chrom in pile_dict:
-            missing_bases = set(range(1,len(base_list)+1))-set(pile_dict[chrom])
-            for each in missing_bases: ref_dict[chrom][each-1]='N'
-        #If the whole chrom has no coverage
-        else:
-            ref_dict[chrom]= ['N']*len(ref_dict[chrom])
+#Changes zero coverage bases (not included in the pileup) to Ns, for 1-based positions start to end (inclusive)
+def zero_to_Ns(seq, start, end):
+    if end>=start: seq[start-1:end]='N'*(end-start+1)
     
 def make_consensus(pileup, ref, opts):
     #Make a dictionary form the reference fasta
-    ref_dict=read_fasta_dict_simple_names(ref)
-    #Turn each seq into a list 
-    for name, seq in ref_dict.iteritems():
-        ref_dict[name]=list(seq)
-    
-    #Replace all 0 coverage bases (not included in the pileup) to Ns
-    zero_to_Ns(ref_dict, pileup)
+    ref_dict=load_ref(ref)
     
     #Open file to append info about changes that are made
     change_log='change_log.txt'
     fout=open(change_log, 'a')
     num_changes=0					#Will keep track of the number of changes that are made to the consensus
     
-    #Will hold positions that have been deleted and therefore the pileup positions for these will be skipped
-    to_ignore={}
+    #Consensus calls for different contigs are independent, so each contig can be run in a separate process
+    if opts.parallelContigs:
+        called = parallel_consensus(pileup, ref, ref_dict, opts)
+        #Write out changes in the same order as the contigs in the pileup
+        for chrom, (seq, chrom_changes, chrom_log) in called:
+            ref_dict[chrom]=seq
+            num_changes+=chrom_changes
+            fout.write(chrom_log)
+        called=dict(called)
+    
+    else:
+        #With --pysamPile, pileup is the sorted bam
+        if opts.pysamPile: columns=bam_pileup_columns(pileup, ref, opts)
+        else: columns=pileup_columns(pileup)
         
+        #Single pass through the pileup, one contig at a time. Zero coverage bases are found as the gaps between pileup positions
+        called={}
+        for chrom, chrom_columns in itertools.groupby(columns, key=lambda column: column[0]):
+            ref_dict[chrom], chrom_changes = consensus_contig(chrom, ref_dict[chrom], chrom_columns, fout, opts)
+            num_changes+=chrom_changes
+            called[chrom]=''
+    fout.close()
+    
+    #If the whole chrom has no coverage
+    for chrom, seq in ref_dict.iteritems():
+        if chrom not in called: ref_dict[chrom]='N'*len(seq)
+    
+    #Write new consensus fasta file
+    new_cons_name = 'new_consensus.fasta'
+    write_fasta(["%s_%s" % (opts.out ,x) for x in ref_dict.keys()], ref_dict.values(), new_cons_name)
+    
+    return num_changes, new_cons_name
+
+#Splits the pileup (or bam, with --pysamPile) by contig and makes the consensus for each contig in a process pool of size opts.procs
+#Returns a list with one entry per contig, in pileup order: [chrom, [new seq, # changes, change log lines]]
+def parallel_consensus(pileup, ref, ref_dict, opts):
+    if opts.pysamPile:
+        #Only imported here so that pysam is not needed unless --pysamPile is used
+        import pysam
+        bam=pysam.AlignmentFile(pileup, 'rb')
+        tasks=[[chrom, ref_dict[chrom], pileup, ref, chrom, None, opts] for chrom in bam.references]
+        bam.close()
+    else:
+        tasks=[[chrom, ref_dict[chrom], pileup, ref, start, end, opts] for chrom, start, end in pileup_contig_offsets(pileup)]
+    
+    pool=multiprocessing.Pool(opts.procs)
+    results=pool.map(consensus_contig_worker, tasks)
+    pool.close()
+    pool.join()
+    return [[task[0], result] for task, result in zip(tasks, results)]
+
+#Called in a separate process for each contig. The change log lines are returned instead of written so that they can be combined in order
+#For bams, start is the name of the contig to pileup. For pileup files, start and end are the byte offsets of the lines for the contig
+def consensus_contig_worker(task):
+    chrom, ref_seq, pileup, ref, start, end, opts = task
+    if opts.pysamPile: columns=bam_pileup_columns(pileup, ref, opts, [start])
+    else: columns=pileup_columns(pileup, start, end)
+    fout=StringIO()
+    seq, num_changes = consensus_contig(chrom, ref_seq, columns, fout, opts)
+    return seq, num_changes, fout.getvalue()
+
+#Returns a list with the byte offsets for the first and last+1 lines for each contig in a pileup file: [chrom, start, end]
+def pileup_contig_offsets(pileup):
+    offsets=[]
     fin=open(pileup, 'r')
-    current_chrom=''					#Need this so that we can reset base_base each time a new contig is encountered
+    current_chrom=''
+    offset=0
     for line in fin:
-        chrom, pos, bases, indels, ends, quals = pileup_info(line)
-        
-        #Extract only 'good' quality bases
-        good_bases, good_quals = quality_filter(bases, quals, opts)
-
+        chrom=line.split('\t', 1)[0]
         if chrom != current_chrom:
-            base_base=-1				#This value changes with insertions and deletions to keep the position to index relationship correct, it starts at -1 b/c pos is 1-based and indices are 0-based
+            if offsets: offsets[-1][2]=offset
+            offsets.append([chrom, offset, None])
             current_chrom=chrom
+        offset+=len(line)
+    fin.close()
+    if offsets: offsets[-1][2]=offset
+    return offsets
+
+#Makes the consensus for a single contig from the pileup positions for that contig. Returns the new sequence and the number of changes made
+def consensus_contig(chrom, ref_seq, columns, fout, opts):
+    #Substitutions and Ns are made in place, so seq always stays in reference coordinates (index = pos-1)
+    seq=bytearray(ref_seq)
+    #Insertions and deletions are recorded here, in position order, and only applied once the whole contig is done
+    #One entry per indel: [pos the indel follows, inserted bases, # of bases deleted]
+    edits=[]
+    #True for positions that have been deleted, the pileup positions for these will be skipped. Index = pos, so position 0 is never used
+    deleted=np.zeros(len(ref_seq)+1, dtype=bool)
+    num_changes=0
+    last_pos=0					#Last position seen in the pileup, used to find zero coverage gaps
+    
+    for chrom, pos, bases, indels, ends, quals in columns:
+        
+        #Replace all 0 coverage bases between the last pileup position and this one with Ns
+        zero_to_Ns(seq, last_pos+1, pos-1)
+        last_pos=pos
+        
+        #Count each base, using only 'good' quality bases
+        good_counts, good_depth = good_base_counts(bases, quals, opts)
         
         #Make sure this position has not been deleted
-        if pos not in to_ignore:
+        if not deleted[pos]:
             #Change the base at a given position if it is more than the specified % of bases support an alternative
             #Also change to an N if less that opts.covThresh coverage for any particular base 
-            if len(good_bases)<1:alt='N'
-            else: alt=majority_alt(good_bases, opts)
+            if good_depth<1:alt='N'
+            else: alt=majority_alt(good_counts, good_depth, opts)
             if alt: 
                 num_changes+=1
-                ref_base=ref_dict[chrom][pos+base_base]
-                if len(good_bases)==0: fout.write('%s\t%d\t%s\t%s\t%d\t%.2f\t%.2f\t%d\n' % (chrom, pos, ref_base, alt, len(bases), bases.count(ref_base)/len(bases), bases.count(alt)/len(bases), len(good_bases)))
-                else: fout.write('%s\t%d\t%s\t%s\t%d\t%.2f\t%.2f\t%d\t%.2f\t%.2f\n' % (chrom, pos, ref_base, alt, len(bases), (bases.count('.')+bases.count(','))/len(bases), bases.count(alt)/len(bases), len(good_bases), (good_bases.count('.')+good_bases.count(','))/len(good_bases), good_bases.count(alt)/len(good_bases)))
-                ref_dict[chrom][pos+base_base]=alt
+                ref_base=chr(seq[pos-1])
+                if good_depth==0: fout.write('%s\t%d\t%s\t%s\t%d\t%.2f\t%.2f\t%d\n' % (chrom, pos, ref_base, alt, len(bases), bases.count(ref_base)/len(bases), bases.count(alt)/len(bases), good_depth))
+                else: fout.write('%s\t%d\t%s\t%s\t%d\t%.2f\t%.2f\t%d\t%.2f\t%.2f\n' % (chrom, pos, ref_base, alt, len(bases), (bases.count('.')+bases.count(','))/len(bases), bases.count(alt)/len(bases), good_depth, (good_counts[REF_CODES].sum())/good_depth, good_counts[ord(alt)]/good_depth))
+                seq[pos-1]=alt
                 
         
             #Insert or remove bases if more than the specified % of bases support an indel
@@ -735,51 +1425,93 @@ def make_consensus(pileup, ref, opts):
                             num_changes+=1
                             #!!!!!This output has not been updated to match the changes made in the SNP output
                             fout.write('%s\t%d\t-\t%s\t%.2f\t%d\n' % (chrom, pos, each, indels['insert'].count(each)/(len(bases)-ends), len(bases)-ends))
-                            ref_dict[chrom].insert((pos+base_base+1), each)
-                            base_base+=1							#Need to increment this because all subsequent indices have been shifted forwards
+                            edits.append([pos, each, 0])
                             break    
                 #If some reads show deletions after this base
                 elif 'delete' in indels:
                     for each in set(indels['delete']):        
                         if indels['delete'].count(each)/(len(bases)-ends)>opts.propThresh and (indels['delete'].count(each)-ends)>=opts.covThresh:
-                            pos_to_ignore=pos
                             num_changes+=1
                             #!!!!!This output has not been updated to match the changes made in the SNP output
                             fout.write('%s\t%d\t%s\t-\t%.2f\t%d\n' % (chrom, pos, each, indels['delete'].count(each)/(len(bases)-ends), len(bases)-ends))
-                            for position in each:
-                                pos_to_ignore+=1
-                                to_ignore[pos_to_ignore]=''
-                                del(ref_dict[chrom][pos+base_base+1])
-                            base_base-=len(each)							#Need to decrement this because all subsequent indices have been shifted backwards
+                            deleted[pos+1:pos+1+len(each)]=True
+                            edits.append([pos, '', len(each)])
                             break
     
-    #Turn each seq into a string
-    for name, seq in ref_dict.iteritems():
-        ref_dict[name]=''.join(seq)
+    #Replace all 0 coverage bases after the last pileup position with Ns
+    zero_to_Ns(seq, last_pos+1, len(ref_seq))
     
-    #Write new consensus fasta file
-    new_cons_name = 'new_consensus.fasta'
-    write_fasta(["%s_%s" % (opts.out ,x) for x in ref_dict.keys()], ref_dict.values(), new_cons_name)
-    
-    return num_changes, new_cons_name
+    #Apply the indels and turn the seq back into a string
+    return apply_edits(seq, edits), num_changes
+
+#Builds the final sequence in one pass, from the in place edited bases and the list of indels (which must be in position order)
+def apply_edits(seq, edits):
+    pieces=[]
+    index=0						#Index of the first base in seq that has not been copied yet
+    for pos, inserted, num_deleted in edits:
+        pieces.append(str(seq[index:pos]))
+        pieces.append(inserted)
+        index=max(index, pos+num_deleted)
+    pieces.append(str(seq[index:]))
+    return ''.join(pieces)
                         
-def majority_alt(bases, opts):
-    for b in ['A', 'C', 'G', 'T']:
-        if bases.count(b)/len(bases)>opts.propThresh and bases.count(b)>=opts.covThresh: return b
+#counts is indexed by the ascii code of each base character in the pileup
+def majority_alt(counts, depth, opts):
+    for b, code in BASE_CODES:
+        if counts[code]/depth>opts.propThresh and counts[code]>=opts.covThresh: return b
     #If none of the alts are above the propThresh
-    if bases.count('.') + bases.count(',')<opts.covThresh: return 'N'
+    if counts[REF_CODES].sum()<opts.covThresh: return 'N'
     return False
     
+#Base quality filter for all of the bases at a position at once. Returns True for each base with quality >= opts.baseQual
+def quality_mask(quals, opts):
+    return np.frombuffer(quals, dtype=np.uint8) >= opts.offset+opts.baseQual
+
+#Returns the number of times each base character is seen, indexed by ascii code, along with the total number of bases, after removing bases with quality < opts.baseQual
+def good_base_counts(bases, quals, opts):
+    good_bases=np.frombuffer(bases, dtype=np.uint8)[quality_mask(quals, opts)]
+    return np.bincount(good_bases, minlength=128), len(good_bases)
+
+#Ascii codes used to look up base counts. Both . and , are matches to the reference
+BASE_CODES=[(b, ord(b)) for b in ['A', 'C', 'G', 'T']]
+REF_CODES=[ord('.'), ord(',')]
+
+#To find read starts (with the associated mapping quality character) and indels in the bases column of a pileup
+read_starts=re.compile(r'\^.', re.DOTALL)
+indel_lengths=re.compile(r'([+-])([0-9]+)')
+
+#Steps through a pileup file made by samtools mpileup, one position at a time
+#start and end are optional byte offsets, used to step through just part of the file
+def pileup_columns(pileup, start=0, end=None):
+    fin=open(pileup, 'r')
+    fin.seek(start)
+    offset=start
+    for line in fin:
+        if end is not None and offset>=end: break
+        offset+=len(line)
+        yield pileup_info(line)
+    fin.close()
 
-def quality_filter(bases, quals, opts):
-    new_bases=[]
-    new_quals=[]
-    for index in range(len(bases)):
-        if ord(quals[index])-opts.offset >= opts.baseQual:
-            new_bases.append(bases[index])
-            new_quals.append(quals[index])
-    return new_bases, new_quals
-
+#Same output as pileup_columns, but the pileup is made in process with pysam, directly from a sorted and indexed bam
+#Uses the same settings as the samtools mpileup commands: -q opts.mapQ, -d opts.maxCov, -B, -A (if opts.useAnomPairs) and the samtools default minimum base quality of 13
+#chroms is an optional list of contigs to pileup, otherwise all contigs are used
+def bam_pileup_columns(bam_name, ref, opts, chroms=None):
+    #Only imported here so that pysam is not needed unless --pysamPile is used
+    import pysam
+    bam=pysam.AlignmentFile(bam_name, 'rb')
+    fasta=pysam.FastaFile(ref)
+    if not chroms: chroms=bam.references
+    for chrom in chroms:
+        for column in bam.pileup(chrom, stepper='samtools', fastafile=fasta, min_mapping_quality=opts.mapQ, max_depth=opts.maxCov, compute_baq=False, ignore_orphans=not opts.useAnomPairs, min_base_quality=13):
+            #Bases are marked the same way as in the text pileup, so they can be parsed the same way
+            raw_bases=''.join(column.get_query_sequences(mark_matches=True, mark_ends=True, add_indels=True)).upper()
+            quals=pysam.qualities_to_qualitystring(column.get_query_qualities(), offset=opts.offset)
+            #Positions where all of the bases were filtered out are treated as zero coverage
+            if not quals: continue
+            bases, indels, ends = parse_bases(raw_bases, len(quals))
+            yield chrom, column.reference_pos+1, bases, indels, ends, quals
+    bam.close()
+    fasta.close()
 
 def pileup_info(line):
     cols=line.strip().split('\t')
@@ -793,79 +1525,58 @@ def pileup_info(line):
 def parse_bases(raw_bases, num_reads):
     #If any reads begin at this position, remove these markers and the associated mapping quality info
     if '^' in raw_bases:
-        bases=remove_beg_info(raw_bases)
+        bases=read_starts.sub('', raw_bases)
     else: bases=raw_bases
     #Count the number of reads ending and then remove the $ charcters
     ends=bases.count('$')
-    bases=bases.replace('$', '')
+    if ends: bases=bases.replace('$', '')
     
     #Get info about indels following this position and remove this info form bases
     indels={}		#This line is needed to ensure an empty dict named indels for strings without indel present
     if '-' in bases or '+' in bases:
-        bases, indels = indel_info(bases, indels)
+        bases, indels = indel_info(bases)
     
     if len(bases)==num_reads: return bases, indels, ends
     else:
         print 'Problem!!! Exp bases: %d, Output bases: %d, Input str: %s, Output str: %s' % (num_reads, len(bases), raw_bases, bases)
         return #This will cause script to stop because three arguments are expected to be returned	
 
-def remove_beg_info(bases):
-    while '^' in bases:
-        index=bases.index('^')
-        bases=bases[:index]+bases[index+2:]
-    return bases
-
-def indel_info(bases, ind_dict):
+#Single scan through the bases, no recursion. Runs of bases between indels are copied over as slices
+#Indel sequences never contain +, - or digits, so every match is the start of a new indel
+def indel_info(bases):
     ind_dict={}
-    if '-' in bases:
-        del_info=[]
-        new_bases, del_info = characterize_indel(bases, '-', del_info)
-        ind_dict['delete']=del_info
-        bases=new_bases                
-    if '+' in bases:
-        ins_info=[]
-        new_bases, ins_info = characterize_indel(bases, '+', ins_info)
-        ind_dict['insert']=ins_info
-        bases=new_bases
-    return bases, ind_dict
-
-def characterize_indel(bases, type_char, ind_info):
-#    print bases
-    start_index=bases.index(type_char)
-    digitcount=0
-    for each in bases[start_index+1:]:
-        if each.isdigit(): digitcount+=1
-        else: break
-    indel_bases=int(bases[start_index+1:start_index+1+digitcount])
-#    print indel_bases
-    indel_str=bases[start_index+1+digitcount:start_index+1+digitcount+indel_bases]
-#    print indel_str
-        
-    ind_info.append(indel_str)
-    bases=bases[:start_index]+bases[start_index+1+digitcount+indel_bases:]   
-    #Recursively go through this process if the string has more indel info
-    if type_char in bases: bases, ind_info = characterize_indel(bases, type_char, ind_info)
-    
-    return bases, ind_info
+    new_bases=[]
+    index=0
+    for indel in indel_lengths.finditer(bases):
+        new_bases.append(bases[index:indel.start()])
+        index=indel.end()+int(indel.group(2))
+        if indel.group(1)=='-': indel_type='delete'
+        else: indel_type='insert'
+        if indel_type not in ind_dict: ind_dict[indel_type]=[]
+        ind_dict[indel_type].append(bases[indel.end():index])
+    new_bases.append(bases[index:])
+    return ''.join(new_bases), ind_dict
 
 # will cut fasta name off at the first whitespace
+#Gzipped fastas (.gz) are decompressed through a pipe, like the fastqs
 def read_fasta_lists_simple_names(file):
-    fin = open(file, 'r')
+    fin = fastq_open(file)
     count=0
 
     names=[]
     seqs=[]
-    seq=''
+    seq=[]
     for line in fin:
         line=line.strip()
         if line and line[0] == '>':                #indicates the name of the sequence
             count+=1
             names.append(line[1:].split()[0])
             if count>1:
-                seqs.append(seq)
-            seq=''
-        else: seq +=line
-    seqs.append(seq)
+                seqs.append(''.join(seq))
+            seq=[]
+        else: seq.append(line)
+    seqs.append(''.join(seq))
+    fastq_close(fin)
 
     return names, seqs
 
@@ -882,42 +1593,102 @@ def read_fasta_dict_simple_names(file):
     fasta_dict = dict(zip(names, seqs))
     return fasta_dict
 
+#Parsed references, by (path, size, modification time), so that each reference is only read once per process
+ref_cache={}
+
+#Returns a new dictionary with the sequences of the reference, just like read_fasta_dict_simple_names
+#The reference is read through its .fai the first time, and then comes from ref_cache
+def load_ref(ref):
+    info=os.stat(ref)
+    id=(os.path.abspath(ref), info.st_size, info.st_mtime)
+    if id not in ref_cache:
+        make_faidx(ref)
+        #The .fai offsets of a bgzipped fasta are for the uncompressed sequence, so it can't be read through the memory map
+        if os.path.isfile('%s.fai' % ref) and not ref.endswith('.gz'): ref_cache[id]=read_fasta_faidx(ref)
+        #If samtools couldn't index the fasta
+        else: ref_cache[id]=read_fasta_lists_simple_names(ref)
+    names, seqs = ref_cache[id]
+    return dict(zip(names, seqs))
+
+#Reads each contig with a single slice of the memory mapped fasta, using the offset and line lengths in the .fai
+def read_fasta_faidx(ref):
+    names=[]
+    seqs=[]
+    fin=open(ref, 'rb')
+    fasta=mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    for line in open('%s.fai' % ref, 'r'):
+        cols=line.split('\t')
+        length, offset, line_bases, line_width = [int(x) for x in cols[1:5]]
+        if line_bases: end=offset + (length//line_bases)*line_width + length%line_bases
+        else: end=offset
+        names.append(cols[0])
+        seqs.append(fasta[offset:end].replace('\n', '').replace('\r', ''))
+    fasta.close()
+    fin.close()
+    return names, seqs
+
 ###------------END of functions used in building new consensus from pileup----------------------------
 
 ###----------Start of bowtie2 functions----------------------------------------
 
+#Returns the name of the index
+#With --indexCache, the index is built once for each reference checksum and kept in that directory
+#A lock file makes any other sample that needs the same index wait while it is being built, instead of building it too
+def bowtie2_build(ref, opts):
+    if not opts.indexCache:
+        #Make index for reference
+        cmd='bowtie2-build %s ref_index' % (ref)
+        print cmd
+        os.popen(cmd)
+        return 'ref_index'
+    
+    index_dir=os.path.join(opts.indexCache, file_key(ref))
+    try: os.makedirs(opts.indexCache)
+    except OSError: pass
+    lock=open('%s.lock' % index_dir, 'w')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+        #The complete file is only written once bowtie2-build has finished successfully
+        if os.path.isfile(os.path.join(index_dir, 'complete')): print 'Using bowtie2 index in %s' % index_dir
+        else:
+            if os.path.isdir(index_dir): shutil.rmtree(index_dir)
+            os.mkdir(index_dir)
+            cmd='bowtie2-build %s %s/ref_index' % (ref, index_dir)
+            print cmd
+            build=Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
+            build.communicate()
+            if build.returncode == 0: open(os.path.join(index_dir, 'complete'), 'w').close()
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+    return os.path.join(index_dir, 'ref_index')
+
 ##!!! Expecting fastq quality scores to be 33-offset
+#The bowtie2 output is piped into samtools, so the alignments are only written (and cached) as a bam, never as a sam
 def bowtie2_index_align(ref, opts):
     
-    #Make index for reference
-    cmd='bowtie2-build %s ref_index' % (ref)
-    print cmd
-    os.popen(cmd)
+    index=bowtie2_build(ref, opts)
     
-    sam_name='%s_aligned.sam' % opts.out
+    align_cmd=bowtie2_cmd('-', index, opts)
+    if not align_cmd: raise Exception('No reads to align with bowtie2')
+    bam_name='%s_aligned.bam' % opts.out
+    run_pipeline(['%s 2>%s_bowtie2.log' % (align_cmd, opts.out), 'samtools view -bS - >%s' % bam_name])
     
+    return bam_name
+
+#Returns the bowtie2 command for the reads that were provided, with output going to sam_name ('-' for stdout)
+def bowtie2_cmd(sam_name, index, opts):
     #Align unpaired reads
     if opts.unpaired and opts.paired1 and opts.paired2:
-        cmd='bowtie2 -p %d --phred33 -N 1 --n-ceil %s -x ref_index -U %s -1 %s -2 %s -S %s' % (opts.procs, opts.nceil, opts.unpaired, opts.paired1, opts.paired2, sam_name)
-        print cmd
-        unpaired_bowtie=Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
-        unpaired_bowtie.wait()
+        return 'bowtie2 -p %d --phred33 -N 1 --n-ceil %s -x %s -U %s -1 %s -2 %s -S %s' % (opts.procs, opts.nceil, index, opts.unpaired, opts.paired1, opts.paired2, sam_name)
     elif opts.unpaired:
-        cmd='bowtie2 -p %d --phred33 -N 1 --n-ceil %s -x ref_index -U %s -S %s' % (opts.procs, opts.nceil, opts.unpaired, sam_name)
-        print cmd
-        unpaired_bowtie=Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
-        unpaired_bowtie.wait()
+        return 'bowtie2 -p %d --phred33 -N 1 --n-ceil %s -x %s -U %s -S %s' % (opts.procs, opts.nceil, index, opts.unpaired, sam_name)
     #Align paired reads    
     elif opts.paired1 and opts.paired2:
-        cmd='bowtie2 -p %d --phred33 -N 1 -I %d -X %d --n-ceil %s -x ref_index -1 %s -2 %s -S %s' % (opts.procs, opts.minIns, opts.maxIns, opts.nceil, opts.paired1, opts.paired2, sam_name)
-        print cmd
-        paired_bowtie=Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
-        paired_bowtie.wait()
+        return 'bowtie2 -p %d --phred33 -N 1 -I %d -X %d --n-ceil %s -x %s -1 %s -2 %s -S %s' % (opts.procs, opts.minIns, opts.maxIns, opts.nceil, index, opts.paired1, opts.paired2, sam_name)
     else: 
         print 'Must provide at least 1) an unpaired .fastq file (-u) or 2) two paired end fastq files (-1 and -2)!!!!'
         return
-    
-    return sam_name
 
 ###----------End of bowtie2 functions----------------------------------------
 
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+#Micro-benchmark for the pileup bases column parser (parse_bases) used in consensus_fasta.py and missing_genes_v1.0.py
+#Compares the current single scan parser with the older recursive, string slicing version on simulated deep pileup columns
+#Also checks that both versions return the same bases, indels and number of read ends
+
+from __future__ import division
+import sys, optparse, os, imp, random, time
+
+def main():
+
+    #To parse command line
+    usage = "usage: %prog [options]"
+    p = optparse.OptionParser(usage)
+
+    p.add_option('-s', '--script', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'consensus_fasta.py'), help='Script containing the parse_bases function to test [consensus_fasta.py in the same directory as this script]')
+    p.add_option('-d', '--depths', default='50,300,500,1000', help='Comma separated list of column depths to test [50,300,500,1000]')
+    p.add_option('-n', '--numCols', type='int', default=2000, help='Number of simulated pileup columns for each depth [2000]')
+    p.add_option('--indelRate', type='float', default=0.05, help='Proportion of reads with an indel after each position [0.05]')
+    p.add_option('--endRate', type='float', default=0.02, help='Proportion of reads beginning (and ending) at each position [0.02]')
+    p.add_option('--seed', type='int', default=1, help='Seed for the random number generator [1]')
+
+    opts, args = p.parse_args()
+
+    random.seed(opts.seed)
+    current = imp.load_source('current_parser', opts.script)
+
+    #The recursive version needs a high recursion limit for deep columns
+    sys.setrecursionlimit(50000)
+
+    print "Depth\t#Cols\tRecursive(s)\tSingleScan(s)\tSpeedup"
+    for depth in [int(x) for x in opts.depths.split(',')]:
+        cols=[simulate_column(depth, opts) for i in range(opts.numCols)]
+
+        start=time.time()
+        old_results=[legacy_parse_bases(raw_bases, depth) for raw_bases in cols]
+        old_time=time.time()-start
+
+        start=time.time()
+        new_results=[current.parse_bases(raw_bases, depth) for raw_bases in cols]
+        new_time=time.time()-start
+
+        #Make sure both versions agree before reporting times
+        for raw_bases, old, new in zip(cols, old_results, new_results):
+            if old != new:
+                print 'Problem!!! Parsers disagree for: %s' % raw_bases
+                return
+
+        print "%d\t%d\t%.3f\t%.3f\t%.1fx" % (depth, opts.numCols, old_time, new_time, old_time/new_time)
+
+###-----------------End of main()--------------------------->>>
+
+#Makes the bases column (upper case, as it is used in the scripts) of a pileup line with the specified number of reads
+def simulate_column(depth, opts):
+    col=[]
+    for i in range(depth):
+        if random.random() < opts.endRate: col.append('^%s' % chr(random.randint(33, 126)))
+        col.append(random.choice('..........,,,,,,,,,,ACGTN*'))
+        if random.random() < opts.indelRate:
+            indel_len=random.randint(1, 12)
+            col.append('%s%d%s' % (random.choice('+-'), indel_len, ''.join([random.choice('ACGTN') for x in range(indel_len)])))
+        if random.random() < opts.endRate: col.append('$')
+    return ''.join(col)
+
+###-----Older recursive version of parse_bases, kept here for comparison
+
+def legacy_parse_bases(raw_bases, num_reads):
+    #If any reads begin at this position, remove these markers and the associated mapping quality info
+    if '^' in raw_bases:
+        bases=legacy_remove_beg_info(raw_bases)
+    else: bases=raw_bases
+    #Count the number of reads ending and then remove the $ charcters
+    ends=bases.count('$')
+    bases=bases.replace('$', '')
+
+    #Get info about indels following this position and remove this info form bases
+    indels={}
+    if '-' in bases or '+' in bases:
+        bases, indels = legacy_indel_info(bases, indels)
+
+    if len(bases)==num_reads: return bases, indels, ends
+
+def legacy_remove_beg_info(bases):
+    while '^' in bases:
+        index=bases.index('^')
+        bases=bases[:index]+bases[index+2:]
+    return bases
+
+def legacy_indel_info(bases, ind_dict):
+    ind_dict={}
+    if '-' in bases:
+        del_info=[]
+        new_bases, del_info = legacy_characterize_indel(bases, '-', del_info)
+        ind_dict['delete']=del_info
+        bases=new_bases
+    if '+' in bases:
+        ins_info=[]
+        new_bases, ins_info = legacy_characterize_indel(bases, '+', ins_info)
+        ind_dict['insert']=ins_info
+        bases=new_bases
+    return bases, ind_dict
+
+def legacy_characterize_indel(bases, type_char, ind_info):
+    start_index=bases.index(type_char)
+    digitcount=0
+    for each in bases[start_index+1:]:
+        if each.isdigit(): digitcount+=1
+        else: break
+    indel_bases=int(bases[start_index+1:start_index+1+digitcount])
+    indel_str=bases[start_index+1+digitcount:start_index+1+digitcount+indel_bases]
+
+    ind_info.append(indel_str)
+    bases=bases[:start_index]+bases[start_index+1+digitcount+indel_bases:]
+    #Recursively go through this process if the string has more indel info
+    if type_char in bases: bases, ind_info = legacy_characterize_indel(bases, type_char, ind_info)
+
+    return bases, ind_info
+
+###------------->>>
+
+if __name__ == "__main__":
+    main()
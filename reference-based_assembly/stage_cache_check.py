@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+#Check for the stage cache (--cacheDir) in consensus_fasta.py
+#Runs a small stage with one setting, then with another setting, and then with the first setting again, and makes sure that each cache entry still holds its own output
+#Also checks that a stage found in the cache only copies its output out when restore_cached asks for it
+#The stage writes its output in place both from python (open(x, 'w')) and from the shell (>x), like the steps in the pipeline do
+
+from __future__ import division
+import sys, optparse, os, imp, tempfile, shutil
+
+def main():
+
+    #To parse command line
+    usage = "usage: %prog [options]"
+    p = optparse.OptionParser(usage)
+
+    p.add_option('-s', '--script', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'consensus_fasta.py'), help='Script containing the cached_stage function to test [consensus_fasta.py in the same directory as this script]')
+    p.add_option('--keep', default=False, action='store_true', help='Use this flag to keep the temporary directory with the cache [False]')
+
+    opts, args = p.parse_args()
+
+    current = imp.load_source('current_cache', opts.script)
+    start_dir=os.getcwd()
+    work_dir=tempfile.mkdtemp(prefix='stage_cache_check_')
+    os.chdir(work_dir)
+    cache_opts=optparse.Values({'cacheDir':os.path.join(work_dir, 'cache')})
+
+    fout=open('input.txt', 'w')
+    fout.write('input\n')
+    fout.close()
+
+    problems=0
+    for writer in ['python', 'shell']:
+        #Same working directory for every run, like a rerun of a sample with --cacheDir
+        for mapQ in [20, 10, 20, 10]:
+            out=current.cached_stage('check_%s' % writer, ['input.txt'], [mapQ], cache_opts, fake_stage, writer, mapQ)
+            current.restore_cached(out)
+            if read_file(out) != 'mapQ %d\n' % mapQ:
+                print 'Problem!!! %s stage with mapQ %d returned: %s' % (writer, mapQ, read_file(out).strip())
+                problems+=1
+
+        #Each cache entry should still have the output for its own setting
+        for stage_dir in sorted(os.listdir(cache_opts.cacheDir)):
+            if not stage_dir.startswith('check_%s_' % writer): continue
+            stage_out=read_file(os.path.join(cache_opts.cacheDir, stage_dir, 'stage_out.txt'))
+            print '%s\t%s' % (stage_dir, stage_out.strip())
+            if stage_out not in ['mapQ 20\n', 'mapQ 10\n']: problems+=1
+        #A stage found in the cache shouldn't copy its output out until it is asked for
+        os.remove('stage_out.txt')
+        out=current.cached_stage('check_%s' % writer, ['input.txt'], [20], cache_opts, fake_stage, writer, 20)
+        if os.path.isfile(out):
+            print 'Problem!!! The %s stage output was copied out before it was needed' % writer
+            problems+=1
+        current.restore_cached(out)
+        if not os.path.isfile(out) or read_file(out) != 'mapQ 20\n':
+            print 'Problem!!! The %s stage output was not restored' % writer
+            problems+=1
+        
+        entries=set([read_file(os.path.join(cache_opts.cacheDir, x, 'stage_out.txt')) for x in os.listdir(cache_opts.cacheDir) if x.startswith('check_%s_' % writer)])
+        if entries != set(['mapQ 20\n', 'mapQ 10\n']):
+            print 'Problem!!! The %s cache entries do not each hold their own output' % writer
+            problems+=1
+
+    os.chdir(start_dir)
+    if opts.keep: print 'Cache kept in %s' % work_dir
+    else: shutil.rmtree(work_dir)
+
+    if problems: print 'Problem!!! %d problems with the stage cache' % problems
+    else: print 'All cache entries kept their own outputs'
+
+###-----------------End of main()--------------------------->>>
+
+#Stand in for a pipeline step. Writes the setting to stage_out.txt, overwriting any file that is already there
+def fake_stage(writer, mapQ):
+    out_name='stage_out.txt'
+    if writer == 'python':
+        fout=open(out_name, 'w')
+        fout.write('mapQ %d\n' % mapQ)
+        fout.close()
+    else: os.system('echo "mapQ %d" >%s' % (mapQ, out_name))
+    return out_name
+
+def read_file(name):
+    fin=open(name, 'r')
+    contents=fin.read()
+    fin.close()
+    return contents
+
+###------------->>>
+
+if __name__ == "__main__":
+    main()